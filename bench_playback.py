@@ -0,0 +1,70 @@
+# Benchmark: CPU per concurrent stream, PCM decode + Opus re-encode vs. Opus passthrough.
+#
+#   python bench_playback.py                 # generates a 60 s Opus test file with ffmpeg
+#   python bench_playback.py <file-or-url>   # any Opus source, e.g. a stream URL from yt-dlp
+#
+# Both modes read every 20 ms frame as fast as possible. The PCM mode also Opus-encodes each
+# frame, as discord.py's voice thread does. CPU includes this process and the ffmpeg children.
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import discord
+from discord.opus import Encoder
+
+STREAMS = int(os.getenv('BENCH_STREAMS', 8))
+TEST_SECONDS = 60
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def make_test_file():
+    path = os.path.join(tempfile.mkdtemp(), 'bench.webm')
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={TEST_SECONDS}',
+                    '-ac', '2', '-ar', '48000', '-c:a', 'libopus', '-b:a', '128k', path], check=True)
+    return path
+
+def drain(source, encode, frames):
+    encoder = Encoder() if encode else None
+    while True:
+        data = source.read()
+        if not data:
+            break
+        if encoder:
+            encoder.encode(data, Encoder.SAMPLES_PER_FRAME)
+        frames.append(1)
+    source.cleanup()
+
+def run(label, make_source, encode):
+    frames = []
+    cpu_start, wall_start = cpu_seconds(), time.perf_counter()
+    threads = [threading.Thread(target=drain, args=(make_source(), encode, frames)) for _ in range(STREAMS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cpu = cpu_seconds() - cpu_start
+    audio_seconds = len(frames) * 0.02
+    # CPU seconds spent per second of audio delivered, i.e. the share of one core a live stream costs.
+    per_stream = cpu / audio_seconds * 100 if audio_seconds else float('nan')
+    print(f"[BENCH] {label:<22} {STREAMS} streams, {audio_seconds:7.1f} s audio, cpu {cpu:6.2f} s "
+          f"-> {per_stream:5.2f}% of a core per live stream (wall {time.perf_counter() - wall_start:.1f} s)")
+    return per_stream
+
+def main():
+    if not discord.opus.is_loaded():
+        discord.opus._load_default()
+    source = sys.argv[1] if len(sys.argv) > 1 else make_test_file()
+    before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5' if '://' in source else None
+    before = run("PCM + Opus re-encode", lambda: discord.FFmpegPCMAudio(source, before_options=before_options, options='-vn'), True)
+    after = run("Opus passthrough", lambda: discord.FFmpegOpusAudio(source, codec='copy', before_options=before_options, options='-vn'), False)
+    print(f"[BENCH] passthrough uses {before / after:.1f}x less CPU per stream")
+
+if __name__ == '__main__':
+    main()
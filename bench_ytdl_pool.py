@@ -0,0 +1,56 @@
+# Benchmark: fresh YoutubeDL per extraction vs. the warm instance pool used by bot.py.
+#
+#   python bench_ytdl_pool.py                     # construction overhead only (offline)
+#   python bench_ytdl_pool.py <url> [<url> ...]   # full extractions (needs network)
+import os
+import sys
+import time
+
+import yt_dlp
+import bot
+
+ROUNDS = int(os.getenv('BENCH_ROUNDS', 20))
+
+def measure(label, fn):
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for _ in range(ROUNDS):
+        fn()
+    wall = (time.perf_counter() - wall_start) / ROUNDS * 1000
+    cpu = (time.process_time() - cpu_start) / ROUNDS * 1000
+    print(f"[BENCH] {label:<28} wall {wall:8.2f} ms/op   cpu {cpu:8.2f} ms/op")
+    return wall
+
+def main():
+    # The proxy is part of the pool key; pin the options so every round hits the same key.
+    opts = bot.get_ytdlp_options()
+    pool = bot.YoutubeDLPool(max_idle=4, max_age=3600, max_uses=10_000)
+    urls = sys.argv[1:]
+
+    def fresh(url=None):
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            if url:
+                ydl.extract_info(url, download=False)
+            else:
+                # Instantiating extractors is what a real extraction pays for up front.
+                ydl.get_info_extractor('Youtube')
+
+    def pooled(url=None):
+        with pool.checkout(opts) as ydl:
+            if url:
+                ydl.extract_info(url, download=False)
+            else:
+                ydl.get_info_extractor('Youtube')
+
+    print(f"[BENCH] yt-dlp {yt_dlp.version.__version__}, {ROUNDS} rounds")
+    before = measure("fresh YoutubeDL", fresh)
+    after = measure("pooled YoutubeDL", pooled)
+    print(f"[BENCH] construction speedup: {before / after:.1f}x")
+
+    for url in urls:
+        before = measure("fresh extract", lambda: fresh(url))
+        after = measure("pooled extract", lambda: pooled(url))
+        print(f"[BENCH] {url}: {before - after:+.1f} ms saved per extraction")
+    print(f"[BENCH] pool stats: {pool.stats()}")
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
 # --- SYSTEM PATH FIX (MUST BE AT THE VERY TOP) ---
+import time
+# Reference point for the boot timings printed once the bot can answer commands.
+BOOT_STARTED = time.perf_counter()
 import os
 import sys
 import shutil
@@ -38,22 +41,49 @@ import asyncio
 import discord
 from discord import app_commands
 from discord.ext import commands
-import yt_dlp
 from dotenv import load_dotenv
 import concurrent.futures
+import multiprocessing
 import aiohttp
+from aiohttp import web
 import re
-import time
 import json
+import atexit
+import contextlib
+import contextvars
+import itertools
+import weakref
+import functools
+import hashlib
+import shlex
+import sqlite3
+import threading
+import traceback
+import unicodedata
+from collections import Counter, OrderedDict, deque
+from queue import Queue, Empty
 from datetime import datetime
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
 
 load_dotenv()
 
+# --- LAZY IMPORTS: yt-dlp and spotipy take ~0.5 s to import and aren't needed to log in ---
+_yt_dlp = None
+
 def no_bug_report_message(*args, **kwargs):
     return ''
-yt_dlp.utils.bug_reports_message = no_bug_report_message
+
+def get_yt_dlp():
+    """Imports yt-dlp on first use (on_ready warms it in the background)."""
+    global _yt_dlp
+    if _yt_dlp is None:
+        started = time.perf_counter()
+        import yt_dlp
+        yt_dlp.utils.bug_reports_message = no_bug_report_message
+        _yt_dlp = yt_dlp
+        # yt-dlp needs Node.js for YouTube's JS challenges; PATH was fixed up at the top of the file.
+        print(f"[BOOT] Loaded yt-dlp {yt_dlp.version.__version__} in {time.perf_counter() - started:.2f}s "
+              f"(Node.js: {shutil.which('node')})")
+    return _yt_dlp
 
 # --- Configuration ---
 TOKEN = os.getenv('DISCORD_BOT_TOKEN')
@@ -61,48 +91,487 @@ YOUTUBE_API_KEY = os.getenv('YOUTUBE_API_KEY')
 SPOTIPY_CLIENT_ID = os.getenv('SPOTIPY_CLIENT_ID')
 SPOTIPY_CLIENT_SECRET = os.getenv('SPOTIPY_CLIENT_SECRET')
 PROXY_FILE = "proxies.txt"
-
-SONG_LOG_FILE = 'song_log.json'
-EVENT_LOG_FILE = 'event_log.json'
+EXTRACT_CACHE_SIZE = int(os.getenv('EXTRACT_CACHE_SIZE', 2048))
+SEARCH_CACHE_FILE = os.getenv('SEARCH_CACHE_FILE', 'search_cache.db')
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', 7 * 24 * 3600))
+SEARCH_CACHE_NEGATIVE_TTL = int(os.getenv('SEARCH_CACHE_NEGATIVE_TTL', 3600))
+# Searches kept in memory; older ones are read back from the database when asked for again.
+SEARCH_CACHE_MEMORY_SIZE = int(os.getenv('SEARCH_CACHE_MEMORY_SIZE', 4096))
+SPOTIFY_RESOLVE_CONCURRENCY = int(os.getenv('SPOTIFY_RESOLVE_CONCURRENCY', 8))
+YOUTUBE_API_RATE = float(os.getenv('YOUTUBE_API_RATE', 10))
+PROGRESS_REPORT_INTERVAL = 10
+# Global budget for now-playing progress bar edits, and the fastest a single guild's bar refreshes.
+PROGRESS_EDITS_PER_SECOND = float(os.getenv('PROGRESS_EDITS_PER_SECOND', 5))
+PROGRESS_MIN_INTERVAL = float(os.getenv('PROGRESS_MIN_INTERVAL', 1))
+YTDL_POOL_MAX_IDLE = int(os.getenv('YTDL_POOL_MAX_IDLE', 16))
+YTDL_POOL_MAX_AGE = int(os.getenv('YTDL_POOL_MAX_AGE', 1800))
+YTDL_POOL_MAX_USES = int(os.getenv('YTDL_POOL_MAX_USES', 200))
+# Extra attempts on a different proxy when an extraction fails or is blocked.
+EXTRACT_RETRIES = int(os.getenv('EXTRACT_RETRIES', 2))
+# Stream Opus sources straight through instead of decoding to PCM and re-encoding every frame.
+OPUS_PASSTHROUGH = os.getenv('OPUS_PASSTHROUGH', '1') != '0'
+# On-disk Opus cache for frequently played tracks. A size of 0 disables it.
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', 'audio_cache')
+AUDIO_CACHE_MAX_MB = int(os.getenv('AUDIO_CACHE_MAX_MB', 0))
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv('AUDIO_CACHE_MIN_PLAYS', 3))
+AUDIO_CACHE_MAX_TRACK_SECONDS = int(os.getenv('AUDIO_CACHE_MAX_TRACK_SECONDS', 20 * 60))
+# Gapless mode keeps the next track's ffmpeg source open and pre-buffered for an instant switch.
+GAPLESS_MODE = os.getenv('GAPLESS_MODE', '0') == '1'
+GAPLESS_LEAD_SECONDS = int(os.getenv('GAPLESS_LEAD_SECONDS', 20))
+GAPLESS_PREBUFFER_FRAMES = 50
+# A stream that stops this many seconds before its end is treated as failed and resumed from its position.
+RESUME_TOLERANCE_SECONDS = 5
+RESUME_MAX_ATTEMPTS = int(os.getenv('RESUME_MAX_ATTEMPTS', 3))
+# Warm restart: queues, loop flags and positions are snapshotted every PLAYER_SNAPSHOT_INTERVAL
+# seconds (0 = off). With RESTORE_REJOIN=1 the bot rejoins voice after a restart and resumes playing.
+PLAYER_STATE_FILE = os.getenv('PLAYER_STATE_FILE', 'player_state.db')
+PLAYER_SNAPSHOT_INTERVAL = int(os.getenv('PLAYER_SNAPSHOT_INTERVAL', 15))
+RESTORE_REJOIN = os.getenv('RESTORE_REJOIN', '0') == '1'
+# Saved state older than this is dropped instead of restored.
+PLAYER_STATE_MAX_AGE = 24 * 3600
+# YouTube playlists are fetched PLAYLIST_PAGE_SIZE entries at a time, once fewer than
+# PLAYLIST_LOW_WATER of its tracks are left in the queue.
+PLAYLIST_PAGE_SIZE = int(os.getenv('PLAYLIST_PAGE_SIZE', 100))
+PLAYLIST_LOW_WATER = 25
+# Played tracks kept per guild; loop-queue repeats at most this many.
+HISTORY_LIMIT = int(os.getenv('HISTORY_LIMIT', 500))
+# Guilds not connected to voice whose player hasn't changed for this long are dropped from memory.
+PLAYER_IDLE_TIMEOUT = int(os.getenv('PLAYER_IDLE_TIMEOUT', 30 * 60))
+PLAYER_SWEEP_INTERVAL = 60
+# Idle voice sessions: pause when everyone leaves, stop the paused stream (keeping queue and position)
+# after IDLE_RELEASE_AFTER seconds, and leave voice after IDLE_DISCONNECT_AFTER seconds without playing.
+IDLE_PAUSE_WHEN_ALONE = os.getenv('IDLE_PAUSE_WHEN_ALONE', '1') == '1'
+IDLE_RELEASE_AFTER = int(os.getenv('IDLE_RELEASE_AFTER', 300))
+IDLE_DISCONNECT_AFTER = int(os.getenv('IDLE_DISCONNECT_AFTER', 1800))
+IDLE_CHECK_INTERVAL = 15
+
+def parse_shard_ids(value):
+    """'0-3' or '0,2,5' -> [0, 1, 2, 3] / [0, 2, 5]; empty means every shard."""
+    ids = []
+    for part in value.replace(' ', '').split(','):
+        if '-' in part:
+            first, last = part.split('-', 1)
+            ids.extend(range(int(first), int(last) + 1))
+        elif part:
+            ids.append(int(part))
+    return sorted(set(ids)) or None
+
+# Sharding: SHARD_COUNT > 0 runs an AutoShardedBot. SHARD_IDS restricts this process to some of the
+# shards, so launcher.py can split them over several processes.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0))
+SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS', '')) if SHARD_COUNT else None
+# Names this process's log files when several processes share the directory.
+SHARD_TAG = f"shard{SHARD_IDS[0]}-{SHARD_IDS[-1]}" if SHARD_IDS else ''
+# Worker processes for yt-dlp extraction (0 = extract on the thread pool, in this process).
+EXTRACT_PROCESSES = int(os.getenv('EXTRACT_PROCESSES', 0))
+# Threads for blocking work (extraction, ffmpeg spawns, sqlite, Spotify), and how many background jobs
+# (prefetch, playlist pages, cache writes) may wait for one before their callers are held back.
+EXECUTOR_THREADS = int(os.getenv('EXECUTOR_THREADS') or min(32, (os.cpu_count() or 1) + 4))
+EXECUTOR_MAX_BACKLOG = int(os.getenv('EXECUTOR_MAX_BACKLOG', 200))
+# Local Prometheus-style /metrics endpoint (0 = disabled).
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Debug: print the event loop's stack whenever it is blocked longer than this many seconds (0 = off).
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', 0))
+
+SONG_LOG_FILE = f'song_log.{SHARD_TAG}.jsonl' if SHARD_TAG else 'song_log.jsonl'
+EVENT_LOG_FILE = f'event_log.{SHARD_TAG}.jsonl' if SHARD_TAG else 'event_log.jsonl'
+# Pre-JSON Lines logs (one big JSON array), migrated once on startup by the process that owns shard 0.
+LEGACY_LOG_FILES = ({'song_log.json': SONG_LOG_FILE, 'event_log.json': EVENT_LOG_FILE}
+                    if not SHARD_IDS or 0 in SHARD_IDS else {})
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', 2))
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_ROTATE_SECONDS = int(os.getenv('LOG_ROTATE_SECONDS', 7 * 24 * 3600))
+# Hash of the last slash-command tree pushed to Discord; the global sync is skipped while it matches.
+COMMAND_SYNC_FILE = os.getenv('COMMAND_SYNC_FILE', 'command_sync.json')
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
 intents.guilds = True
 
-bot = commands.Bot(command_prefix=" ", intents=intents)
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix=" ", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix=" ", intents=intents)
+
+# --- METRICS: Per-stage timings and counters, exported in Prometheus text format ---
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    """Counters and latency histograms, safe to update from executor and voice threads."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.counters = Counter()
+        # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self.histograms = {}
+        # name -> (help, function returning a number or {label value: number}, label name)
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            buckets = self.histograms.get(key)
+            if buckets is None:
+                buckets = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    buckets[index] += 1
+                    break
+            else:
+                buckets[len(LATENCY_BUCKETS)] += 1
+            buckets[-1] += seconds
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        """Times a block as stage_seconds{stage=...}, with outcome="error" if it raised."""
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'ok'
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - started, stage=stage, outcome=outcome)
+
+    def timed(self, stage):
+        """Decorator form of time() for coroutine functions."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.time(stage):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def gauge(self, name, help_text, func, label=None):
+        self.gauges[name] = (help_text, func, label)
+
+    @staticmethod
+    def _labels(labels):
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+    def render(self):
+        """The /metrics page."""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(buckets)) for key, buckets in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+            lines.append(f"{self.prefix}_{name}{self._labels(labels)} {value}")
+        for (name, labels), buckets in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {self.prefix}_{name} histogram")
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                cumulative += count
+                lines.append(f"{self.prefix}_{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.prefix}_{name}_count{self._labels(labels)} {cumulative}")
+            lines.append(f"{self.prefix}_{name}_sum{self._labels(labels)} {buckets[-1]:.6f}")
+        for name, (help_text, func, label) in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append(f"# HELP {self.prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            if isinstance(value, dict):
+                for key, item in sorted(value.items()):
+                    lines.append(f"{self.prefix}_{name}{self._labels(((label, key),))} {item}")
+            else:
+                lines.append(f"{self.prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def stage_summary(self, histogram='stage_seconds', label='stage'):
+        """[(stage, calls, errors, avg seconds, approx p95 seconds)], slowest p95 first, for /stats."""
+        stages = {}
+        with self._lock:
+            for (name, labels), buckets in self.histograms.items():
+                if name != histogram:
+                    continue
+                labels = dict(labels)
+                merged = stages.setdefault(labels[label], [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets[:-1])]
+                merged[1] += buckets[-1]
+                if labels.get('outcome') == 'error':
+                    merged[2] += sum(buckets[:-1])
+        rows = []
+        for stage, (counts, total, errors) in stages.items():
+            calls = sum(counts)
+            # p95 as the upper bound of the bucket it falls in.
+            target, cumulative, p95 = calls * 0.95, 0, float('inf')
+            for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), counts):
+                cumulative += count
+                if cumulative >= target:
+                    p95 = bound
+                    break
+            rows.append((stage, calls, errors, total / calls if calls else 0.0, p95))
+        return sorted(rows, key=lambda row: row[4], reverse=True)
+
+metrics = Metrics('orion')
 
-# --- HELPER: PROXY ROTATOR ---
-def get_random_proxy():
-    """Reads proxies.txt and returns a random proxy URL, or None if empty."""
-    if not os.path.exists(PROXY_FILE):
-        return None
-    try:
-        with open(PROXY_FILE, 'r') as f:
-            # Filter out empty lines and comments
-            proxies = [line.strip() for line in f if line.strip() and not line.startswith("#")]
-        
-        if proxies:
-            selected = random.choice(proxies)
-            # Log safe part only (hide password in console)
-            safe_log = selected.split('@')[-1] if '@' in selected else selected
-            print(f"[PROXY] Rotating IP... Selected: {safe_log}") 
-            return selected
-    except Exception as e:
-        print(f"[ERROR] Failed to read proxy file: {e}")
-    return None
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a fixed sleep; lag means something blocked it."""
 
-# --- SMART CONFIGURATION (Dynamic) ---
-# Debug: Verify Node is now visible
-node_location = shutil.which('node')
-print(f"[DEBUG] Final Node.js location visible to Python: {node_location}")
+    INTERVAL = 0.5
+
+    def __init__(self):
+        self.last = 0.0
+        self.max = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = bot.loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.INTERVAL)
+            self.last = max(0.0, time.perf_counter() - started - self.INTERVAL)
+            self.max = max(self.max, self.last)
+            metrics.observe('event_loop_lag_seconds', self.last)
+
+loop_lag_monitor = LoopLagMonitor()
+
+class LoopStallWatchdog:
+    """Debug aid: a thread that prints what the event loop is running whenever it stops checking in."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.stalls = 0
+        self._beat = time.perf_counter()
+        self._loop_thread_id = None
+        self._task = None
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.perf_counter()
+        self._task = bot.loop.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        print(f"[WATCHDOG] Reporting event loop stalls over {self.threshold * 1000:.0f} ms.")
+
+    async def _heartbeat(self):
+        while True:
+            self._beat = time.perf_counter()
+            await asyncio.sleep(self.threshold / 4)
+
+    def _watch(self):
+        reported = None
+        while True:
+            time.sleep(self.threshold / 4)
+            beat = self._beat
+            if reported is not None and beat != reported:
+                print(f"[WATCHDOG] Event loop recovered after ~{(beat - reported) * 1000:.0f} ms.")
+                reported = None
+            stalled = time.perf_counter() - beat
+            if stalled < self.threshold or beat == reported:
+                continue
+            reported = beat
+            self.stalls += 1
+            metrics.inc('event_loop_stalls_total')
+            # The loop thread's current frame is the code that is blocking it.
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no frame)\n"
+            print(f"[WATCHDOG] Event loop blocked for {stalled * 1000:.0f} ms so far, in:\n{stack}", end="")
+
+loop_stall_watchdog = LoopStallWatchdog(LOOP_STALL_THRESHOLD) if LOOP_STALL_THRESHOLD > 0 else None
+
+async def handle_metrics_request(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server():
+    """Serves /metrics on METRICS_HOST:METRICS_PORT (plus the first shard id, so shard processes don't collide)."""
+    port = METRICS_PORT + (SHARD_IDS[0] if SHARD_IDS else 0)
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics_request)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    print(f"[INFO] Metrics at http://{METRICS_HOST}:{port}/metrics")
+
+# --- HELPER: PROXY MANAGER ---
+def safe_proxy_name(proxy_url):
+    """Host part of a proxy URL, for logs (hides the password)."""
+    return proxy_url.split('@')[-1] if '@' in proxy_url else proxy_url
+
+class ProxyStats:
+    __slots__ = ('successes', 'failures', 'blocks', 'latency', 'consecutive_failures', 'cooldown_until', 'recent_blocks')
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.blocks = 0
+        self.latency = None
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.recent_blocks = deque(maxlen=20)
+
+    def score(self):
+        # Smoothed success rate per second of latency; unknown proxies get a fair first try.
+        success_rate = (self.successes + 1) / (self.successes + self.failures + 2)
+        return success_rate / max(self.latency or 2.0, 0.25)
+
+class ProxyManager:
+    """Loads proxies.txt once (reloading when it changes) and picks healthy, fast proxies.
+
+    Failing proxies are put on an exponential cooldown; 403/429 responses count double.
+    """
+
+    RELOAD_CHECK_INTERVAL = 5
+    BASE_COOLDOWN = 30
+    MAX_COOLDOWN = 1800
+
+    def __init__(self, path):
+        self.path = path
+        self.proxies = {}
+        self._mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        # Set to a list inside extraction processes to collect outcomes for the main process.
+        self.journal = None
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.RELOAD_CHECK_INTERVAL
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        proxies = []
+        if mtime is not None:
+            try:
+                with open(self.path, 'r') as f:
+                    # Filter out empty lines and comments
+                    proxies = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+            except OSError as e:
+                print(f"[ERROR] Failed to read proxy file: {e}")
+                return
+        # Keep the stats of proxies that are still listed.
+        self.proxies = {proxy: self.proxies.get(proxy) or ProxyStats() for proxy in proxies}
+        print(f"[PROXY] Loaded {len(self.proxies)} proxies from {self.path}.")
+
+    def choose(self, exclude=()):
+        """Returns a proxy URL, or None if there are none configured."""
+        with metrics.time('proxy_choice'), self._lock:
+            self._maybe_reload()
+            candidates = [(proxy, stats) for proxy, stats in self.proxies.items() if proxy not in exclude]
+            if not candidates:
+                candidates = list(self.proxies.items())
+            if not candidates:
+                return None
+            now = time.monotonic()
+            available = [(proxy, stats) for proxy, stats in candidates if stats.cooldown_until <= now]
+            if available:
+                weights = [stats.score() for _, stats in available]
+                selected = random.choices([proxy for proxy, _ in available], weights=weights)[0]
+            else:
+                # Everything is cooling down; use whichever recovers first.
+                selected = min(candidates, key=lambda item: item[1].cooldown_until)[0]
+        print(f"[PROXY] Rotating IP... Selected: {safe_proxy_name(selected)}")
+        return selected
+
+    def record(self, proxy, outcome, latency=None):
+        """outcome is 'ok', 'blocked' (HTTP 403/429) or 'error'."""
+        if proxy is None:
+            return
+        if self.journal is not None:
+            self.journal.append((proxy, outcome, latency))
+        with self._lock:
+            stats = self.proxies.get(proxy)
+            if stats is None:
+                return
+            if outcome == 'ok':
+                stats.successes += 1
+                stats.consecutive_failures = 0
+                if latency is not None:
+                    stats.latency = latency if stats.latency is None else 0.7 * stats.latency + 0.3 * latency
+                return
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            cooldown = self.BASE_COOLDOWN * 2 ** (stats.consecutive_failures - 1)
+            if outcome == 'blocked':
+                stats.blocks += 1
+                stats.recent_blocks.append(time.time())
+                cooldown *= 2
+            stats.cooldown_until = time.monotonic() + min(cooldown, self.MAX_COOLDOWN)
+
+    def snapshot(self):
+        """What choose() and record() go by, per proxy, for handing to an extraction process."""
+        now = time.monotonic()
+        with self._lock:
+            # The main process never calls choose() itself when extraction runs in worker processes.
+            self._maybe_reload()
+            return {proxy: (stats.successes, stats.failures, stats.latency, stats.consecutive_failures,
+                            max(0.0, stats.cooldown_until - now))
+                    for proxy, stats in self.proxies.items()}
+
+    def apply_snapshot(self, snapshot):
+        """Adopts the main process's view of proxy health (runs in an extraction process)."""
+        now = time.monotonic()
+        with self._lock:
+            self._maybe_reload()
+            for proxy, stats in self.proxies.items():
+                if proxy in snapshot:
+                    stats.successes, stats.failures, stats.latency, stats.consecutive_failures, cooldown = snapshot[proxy]
+                    stats.cooldown_until = now + cooldown
+
+    def cooling_down(self, proxy):
+        with self._lock:
+            stats = self.proxies.get(proxy)
+            return stats is not None and stats.cooldown_until > time.monotonic()
+
+    def stats(self):
+        """Per-proxy counters, busiest first."""
+        now = time.monotonic()
+        with self._lock:
+            rows = [{
+                'proxy': safe_proxy_name(proxy),
+                'successes': stats.successes,
+                'failures': stats.failures,
+                'blocks': stats.blocks,
+                'recent_blocks': sum(1 for ts in stats.recent_blocks if time.time() - ts < 600),
+                'latency': round(stats.latency, 2) if stats.latency is not None else None,
+                'cooldown': max(0, round(stats.cooldown_until - now)),
+            } for proxy, stats in self.proxies.items()]
+        return sorted(rows, key=lambda row: row['successes'] + row['failures'], reverse=True)
+
+    def dump(self):
+        lines = [f"{'proxy':<32} {'ok':>6} {'fail':>6} {'403/429':>7} {'10m':>4} {'latency':>8} {'cooldown':>8}"]
+        for row in self.stats():
+            latency = f"{row['latency']:.2f}s" if row['latency'] is not None else "-"
+            lines.append(f"{row['proxy'][:32]:<32} {row['successes']:>6} {row['failures']:>6} {row['blocks']:>7} "
+                         f"{row['recent_blocks']:>4} {latency:>8} {row['cooldown']:>7}s")
+        return "\n".join(lines)
+
+proxy_manager = ProxyManager(PROXY_FILE)
 
-def get_ytdlp_options():
+# --- SMART CONFIGURATION (Dynamic) ---
+def get_ytdlp_options(exclude_proxies=()):
     """Generates options dynamically per-song to allow IP rotation."""
     
     # 1. Base Options
     opts = {
-        "format": "bestaudio/best",
+        # Prefer Opus (YouTube's webm/251) so play_next can stream it without re-encoding.
+        "format": "bestaudio[acodec=opus]/bestaudio/best" if OPUS_PASSTHROUGH else "bestaudio/best",
         "quiet": True,
         "noplaylist": True,
         "default_search": "auto",
@@ -113,8 +582,8 @@ def get_ytdlp_options():
         "source_address": "0.0.0.0", 
     }
 
-    # 2. Inject Random Proxy (If available)
-    proxy_url = get_random_proxy()
+    # 2. Inject the healthiest available proxy (If any)
+    proxy_url = proxy_manager.choose(exclude=exclude_proxies)
     if proxy_url:
         opts["proxy"] = proxy_url
 
@@ -134,43 +603,1238 @@ def get_ytdlp_options():
     return opts
 
 # --- Standard Bot Code ---
-music_queues = {}
-loop_states = {}
-loop_queue_states = {}
-played_songs = {}
-current_song_info = {}
-context_for_guild = {}
-current_playing_messages = {}
-executor = concurrent.futures.ThreadPoolExecutor()
-
-sp = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials(
-    client_id=SPOTIPY_CLIENT_ID,
-    client_secret=SPOTIPY_CLIENT_SECRET
-))
+class Requester:
+    """Who asked for a track. Interned per user, so a 5,000-track playlist shares one instance."""
+    __slots__ = ('id', 'name', 'mention', '__weakref__')
+
+    def __init__(self, user_id, name, mention):
+        self.id = user_id
+        self.name = name
+        self.mention = mention
+
+_requesters = weakref.WeakValueDictionary()
+
+def get_requester(user):
+    return intern_requester(user.id, user.display_name, user.mention)
+
+def intern_requester(user_id, name, mention):
+    requester = _requesters.get(user_id)
+    if requester is None:
+        requester = _requesters[user_id] = Requester(user_id, name, mention)
+    else:
+        requester.name = name
+    return requester
+
+class Track:
+    __slots__ = ('url', 'title', 'requester', 'duration', 'thumbnail')
+
+    def __init__(self, url, title, requester, duration=None, thumbnail=None):
+        self.url = url
+        self.title = title
+        self.requester = requester
+        # Filled in from videos.list (or the playlist listing) so queues can show lengths before a track plays.
+        self.duration = duration
+        self.thumbnail = thumbnail
+
+    def describe(self):
+        return f"{self.title} `{format_time(self.duration)}`" if self.duration else self.title
+
+class GuildPlayer:
+    """All playback state for one guild: queue, history, loop flags and the now-playing message."""
+    __slots__ = ('guild_id', 'queue', 'history', 'replay_index', 'current', 'loop_song', 'loop_queue',
+                 'ctx', 'now_playing_msg', 'prefetch', 'source', 'duration', 'track_ended_at',
+                 'stream_proxy', 'skipping', 'resuming', 'resume_attempts', 'version',
+                 'auto_paused', 'releasing', 'suspended_at', 'left_channel_id')
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.queue = deque()
+        self.history = deque(maxlen=HISTORY_LIMIT)
+        # Loop-queue replays history in place: the index of the next track to replay, or None.
+        self.replay_index = None
+        self.current = None
+        self.loop_song = False
+        self.loop_queue = False
+        self.ctx = None
+        self.now_playing_msg = None
+        self.prefetch = None
+        # The PlaybackSource currently handed to the voice client, and its track's duration.
+        self.source = None
+        self.duration = None
+        self.track_ended_at = None
+        # Stream-failure recovery: which proxy resolved the current stream, whether the user
+        # asked for the stop (skip), and whether a resume is in flight.
+        self.stream_proxy = None
+        self.skipping = False
+        self.resuming = False
+        self.resume_attempts = 0
+        # Bumped on every queue/flag change so snapshots only rewrite guilds that changed.
+        self.version = 0
+        # Idle policy: paused because everyone left, source being released, position to resume
+        # the released track from, and the voice channel left while idle.
+        self.auto_paused = False
+        self.releasing = False
+        self.suspended_at = None
+        self.left_channel_id = None
+
+    def changed(self):
+        self.version += 1
+
+    def start_track(self, source, info):
+        self.source = source
+        self.duration = info.get('duration')
+        self.stream_proxy = info.get('extraction_proxy')
+        self.resume_attempts = 0
+
+    def skip(self, vc):
+        """Stops the current track on purpose, so the after callback doesn't try to resume it."""
+        self.skipping = True
+        vc.stop()
+
+    def enqueue(self, track):
+        self.queue.append(track)
+        self.version += 1
+
+    def enqueue_many(self, tracks):
+        """Bulk insert for playlists."""
+        self.queue.extend(tracks)
+        self.version += 1
+
+    def enqueue_front(self, track):
+        self.queue.appendleft(track)
+        self.version += 1
+
+    def dequeue(self):
+        self.version += 1
+        return self.queue.popleft() if self.queue else None
+
+    def _replay_position(self):
+        """Index into history of the next track to replay, or None if it comes from the queue."""
+        if self.replay_index is not None and self.replay_index < len(self.history):
+            return self.replay_index
+        # A loop ends: tracks queued during it play (and join the loop) before it starts over.
+        if self.loop_queue and self.history and not self.queue:
+            return 0
+        return None
+
+    def peek(self):
+        """Returns the track play_next will pick up next, or None."""
+        if self.loop_song and self.current is not None:
+            return self.current
+        index = self._replay_position()
+        if index is not None:
+            return self.history[index]
+        if self.queue:
+            # The rest of a playlist that hasn't been fetched yet has nothing to prefetch.
+            return self.queue[0] if isinstance(self.queue[0], Track) else None
+        return None
+
+    def advance(self):
+        """Makes the next track current and returns it, or None if there is nothing left to play."""
+        # Song loop repeats in place, ahead of both a loop-queue replay and the queue.
+        if self.loop_song and self.current is not None:
+            self.version += 1
+            return self.current
+        index = self._replay_position()
+        if index is not None:
+            track = self.history[index]
+            self.replay_index = index + 1
+            self.version += 1
+        else:
+            track = self.dequeue()
+            self.replay_index = None
+            if track is not None:
+                self.history.append(track)
+        self.current = track
+        return track
+
+    def rewind(self):
+        """Undoes advance(): the current track becomes the next one again."""
+        track, self.current = self.current, None
+        if track is None:
+            return
+        if self.replay_index and self.history[self.replay_index - 1] is track:
+            self.replay_index -= 1
+            self.version += 1
+            return
+        if self.history and self.history[-1] is track:
+            self.history.pop()
+        self.enqueue_front(track)
+
+    def upcoming(self, limit):
+        """The next `limit` items: tracks, and PlaylistStream placeholders for unfetched playlist tails."""
+        replaying = itertools.islice(self.history, self.replay_index, None) if self.replay_index is not None else ()
+        return list(itertools.islice(itertools.chain(replaying, self.queue), limit))
+
+    def queued_count(self):
+        """Tracks waiting, counting the unfetched remainder of streamed playlists when its size is known."""
+        count = len(self.queue)
+        if self.replay_index is not None:
+            count += max(len(self.history) - self.replay_index, 0)
+        for item in self.queue:
+            if isinstance(item, PlaylistStream):
+                count += (item.remaining or 1) - 1
+        return count
+
+    def playlist_streams(self):
+        return [item for item in self.queue if isinstance(item, PlaylistStream)]
+
+players = {}
+
+def get_player(guild_id):
+    player = players.get(guild_id)
+    if player is None:
+        # A guild with a snapshot from before the restart picks up where it left off.
+        player = players[guild_id] = player_store.restore(guild_id) or GuildPlayer(guild_id)
+    return player
+
+async def discard_player(guild_id):
+    """Drops all of a guild's playback state and deletes its now-playing message."""
+    player_store.forget(guild_id)
+    player = players.pop(guild_id, None)
+    if player is None:
+        return
+    invalidate_prefetch(player)
+    for stream in player.playlist_streams():
+        stream.close()
+    if player.now_playing_msg is not None:
+        try:
+            await player.now_playing_msg.delete()
+        except discord.HTTPException:
+            pass
+
+class PlayerSweeper:
+    """Drops players of guilds that left voice (kicked, moved out, disconnected by the idle policy)
+    and haven't been touched since, so per-guild state doesn't pile up over weeks of uptime."""
+
+    def __init__(self, idle_timeout, interval):
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        # guild_id -> (player version, monotonic time it was first seen unchanged and out of voice)
+        self.idle_since = {}
+        self._task = None
+
+    def start(self):
+        if self.idle_timeout > 0 and (self._task is None or self._task.done()):
+            self._task = background_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"[ERROR] Player sweep failed: {e}")
+
+    async def sweep(self):
+        now = time.monotonic()
+        idle = []
+        for guild_id, player in list(players.items()):
+            guild = bot.get_guild(guild_id)
+            vc = guild.voice_client if guild is not None else None
+            if vc is not None and vc.is_connected():
+                self.idle_since.pop(guild_id, None)
+                continue
+            seen = self.idle_since.get(guild_id)
+            if seen is None or seen[0] != player.version:
+                self.idle_since[guild_id] = (player.version, now)
+            elif now - seen[1] >= self.idle_timeout:
+                idle.append(guild_id)
+        for guild_id in idle:
+            self.idle_since.pop(guild_id, None)
+            await discard_player(guild_id)
+        for guild_id in [guild_id for guild_id in self.idle_since if guild_id not in players]:
+            del self.idle_since[guild_id]
+        player_store.drop_stale()
+        if idle:
+            metrics.inc('players_swept_total', len(idle))
+            print(f"[INFO] Dropped state of {len(idle)} idle guilds ({len(players)} players left).")
+
+player_sweeper = PlayerSweeper(PLAYER_IDLE_TIMEOUT, PLAYER_SWEEP_INTERVAL)
+
+# --- EXECUTOR: Blocking work is dispatched to worker threads by priority, fairly between guilds ---
+PRIORITY_PLAY, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND = range(3)
+PRIORITY_NAMES = ('play', 'interactive', 'background')
+# (priority, guild id) of the executor jobs the current task starts. Tasks inherit it from their creator.
+executor_context = contextvars.ContextVar('executor_context', default=(PRIORITY_INTERACTIVE, None))
+
+@contextlib.contextmanager
+def executor_priority(priority, guild_id=None):
+    token = executor_context.set((priority, guild_id))
+    try:
+        yield
+    finally:
+        executor_context.reset(token)
+
+def background_task(coro, guild_id=None):
+    """create_task for work nobody is waiting on; its executor jobs queue behind playback and commands."""
+    with executor_priority(PRIORITY_BACKGROUND, guild_id):
+        return bot.loop.create_task(coro)
+
+class WorkScheduler:
+    """Hands blocking calls to a pool in priority order instead of the pool's own FIFO.
+
+    Jobs wait here by priority class and guild. A free worker takes a job from the highest
+    class that has one, with guilds taking turns inside a class. Except for tracks about to
+    play, a guild holds at most `guild_limit` workers at once, so one guild's playlist import
+    can't occupy the pool. A guild queuing background work waits while `max_backlog` of its
+    background jobs are already queued, so an import is paced by the workers it gets.
+    """
+
+    def __init__(self, name, pool, workers, max_backlog):
+        self.name = name
+        self.pool = pool
+        self.workers = workers
+        self.guild_limit = max(2, workers // 4)
+        self.max_backlog = max_backlog
+        self.running = 0
+        self.guild_running = Counter()
+        # Per priority: guild id -> deque of (future, call, guild id, queued at), guild whose turn it is first.
+        self.waiting = [OrderedDict() for _ in PRIORITY_NAMES]
+        self.depth = [0] * len(PRIORITY_NAMES)
+        # guild id -> futures of callers waiting for room in its background queue
+        self._backlog_waiters = {}
+
+    def submit(self, func, *args):
+        """Queues func(*args) under the current task's priority and guild; returns an asyncio future."""
+        priority, guild_id = executor_context.get()
+        future = asyncio.get_event_loop().create_future()
+        self.waiting[priority].setdefault(guild_id, deque()).append(
+            (future, functools.partial(func, *args), guild_id, time.perf_counter()))
+        self.depth[priority] += 1
+        self._dispatch()
+        return future
+
+    async def run(self, func, *args):
+        priority, guild_id = executor_context.get()
+        if priority == PRIORITY_BACKGROUND:
+            while len(self.waiting[PRIORITY_BACKGROUND].get(guild_id, ())) >= self.max_backlog:
+                waiter = asyncio.get_event_loop().create_future()
+                self._backlog_waiters.setdefault(guild_id, deque()).append(waiter)
+                await waiter
+        return await self.submit(func, *args)
+
+    def promote(self, guild_id):
+        """Moves a guild's queued background jobs to the front: playback is now waiting on them."""
+        jobs = self.waiting[PRIORITY_BACKGROUND].pop(guild_id, None)
+        if not jobs:
+            return
+        self.depth[PRIORITY_BACKGROUND] -= len(jobs)
+        self.depth[PRIORITY_PLAY] += len(jobs)
+        self.waiting[PRIORITY_PLAY].setdefault(guild_id, deque()).extend(jobs)
+        self._dispatch()
+
+    def _next_job(self):
+        for priority, guilds in enumerate(self.waiting):
+            for guild_id, jobs in guilds.items():
+                if priority != PRIORITY_PLAY and self.guild_running[guild_id] >= self.guild_limit:
+                    continue
+                job = jobs.popleft()
+                if jobs:
+                    guilds.move_to_end(guild_id)
+                else:
+                    del guilds[guild_id]
+                self.depth[priority] -= 1
+                return priority, job
+        return None, None
+
+    def _dispatch(self):
+        while self.running < self.workers:
+            priority, job = self._next_job()
+            if job is None:
+                break
+            future, call, guild_id, queued = job
+            # The caller gave up (skip, disconnect) before the job started.
+            if future.done():
+                continue
+            metrics.observe('executor_wait_seconds', time.perf_counter() - queued,
+                            pool=self.name, priority=PRIORITY_NAMES[priority])
+            self.running += 1
+            self.guild_running[guild_id] += 1
+            inner = asyncio.get_event_loop().run_in_executor(self.pool, call)
+            inner.add_done_callback(functools.partial(self._finished, future, guild_id))
+        for guild_id, waiters in list(self._backlog_waiters.items()):
+            room = self.max_backlog - len(self.waiting[PRIORITY_BACKGROUND].get(guild_id, ()))
+            while room > 0 and waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    room -= 1
+            if not waiters:
+                del self._backlog_waiters[guild_id]
+
+    def _finished(self, future, guild_id, inner):
+        self.running -= 1
+        self.guild_running[guild_id] -= 1
+        if not self.guild_running[guild_id]:
+            del self.guild_running[guild_id]
+        if not future.done():
+            if inner.cancelled():
+                future.cancel()
+            elif inner.exception() is not None:
+                future.set_exception(inner.exception())
+            else:
+                future.set_result(inner.result())
+        self._dispatch()
+
+    def queue_depth(self):
+        return {f"{self.name}/{name}": depth for name, depth in zip(PRIORITY_NAMES, self.depth)}
+
+executor = WorkScheduler('threads', concurrent.futures.ThreadPoolExecutor(max_workers=EXECUTOR_THREADS),
+                         EXECUTOR_THREADS, EXECUTOR_MAX_BACKLOG)
+
+_spotify = None
+
+def get_spotify():
+    """Builds the Spotify client the first time a Spotify link is played."""
+    global _spotify
+    if _spotify is None:
+        import spotipy
+        from spotipy.oauth2 import SpotifyClientCredentials
+        _spotify = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials(
+            client_id=SPOTIPY_CLIENT_ID,
+            client_secret=SPOTIPY_CLIENT_SECRET
+        ))
+    return _spotify
+
+# --- SINGLE-FLIGHT: Concurrent identical lookups share one in-flight call ---
+class SingleFlight:
+    """Runs one call per key at a time; callers arriving while it runs await the same result or error."""
+
+    def __init__(self, name):
+        self.name = name
+        self.inflight = {}
+        self.coalesced = 0
+
+    async def do(self, key, make_coro):
+        task = self.inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            metrics.inc('coalesced_requests_total', kind=self.name)
+        else:
+            task = asyncio.ensure_future(make_coro())
+            self.inflight[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        # Shielded: one caller giving up (a skipped prefetch) mustn't cancel the call for the others.
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        # Mark the error as retrieved in case every caller was cancelled.
+        if not task.cancelled():
+            task.exception()
+
+extraction_flights = SingleFlight('extraction')
+search_flights = SingleFlight('search')
+
+# --- EXTRACTION CACHE: yt-dlp results keyed by video ID ---
+# Seconds of validity a signed stream URL must still have to be reused.
+STREAM_EXPIRY_MARGIN = 60
+YOUTUBE_ID_REGEX = re.compile(r"(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([A-Za-z0-9_-]{11})")
+# Metadata never goes stale; stream fields are only valid until the URL's expire timestamp.
+METADATA_FIELDS = ('id', 'title', 'duration', 'thumbnail', 'artist', 'uploader', 'webpage_url', 'original_url')
+STREAM_FIELDS = ('url', 'acodec', 'ext', 'extraction_proxy')
+
+def get_stream_expiry(audio_url):
+    """Returns the unix timestamp a signed googlevideo URL expires at, or None if it has none."""
+    match = re.search(r"[?&/]expire[=/](\d+)", audio_url or "")
+    return int(match.group(1)) if match else None
+
+def stream_url_expired(audio_url, margin=STREAM_EXPIRY_MARGIN):
+    expire = get_stream_expiry(audio_url)
+    return expire is not None and expire - margin <= time.time()
+
+def get_cache_key(url):
+    """Canonical cache key: the video ID for YouTube links, the URL itself for anything else."""
+    match = YOUTUBE_ID_REGEX.search(url)
+    return f"youtube:{match.group(1)}" if match else url
+
+class ExtractionCache:
+    """Size-bounded LRU of extraction results. Stream URLs are dropped once they expire."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Metadata plus a still-valid stream URL, or None. Counts towards the hit rate."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            stream = entry['stream']
+            if stream and entry['expire'] - STREAM_EXPIRY_MARGIN <= time.time():
+                stream = entry['stream'] = None
+            if stream:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return {**entry['metadata'], **stream}
+        self.misses += 1
+        return None
+
+    def get_metadata(self, key):
+        """Cached metadata without the stream, or None. Not counted: it isn't an extraction lookup."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return dict(entry['metadata'])
+
+    def put(self, key, info):
+        if not info or info.get('_type') == 'playlist':
+            return
+        stream = None
+        expire = get_stream_expiry(info.get('url'))
+        # URLs without an expire parameter (e.g. SoundCloud) may be single-use, so only metadata is kept.
+        if expire is not None:
+            stream = {field: info.get(field) for field in STREAM_FIELDS}
+        self.entries[key] = {
+            'metadata': {field: info.get(field) for field in METADATA_FIELDS},
+            'stream': stream,
+            'expire': expire or 0,
+        }
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def put_metadata(self, key, metadata):
+        """Stores metadata from a source other than yt-dlp, keeping any stream URL already cached."""
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {'metadata': {}, 'stream': None, 'expire': 0}
+        # videos.list has no artist field, for one; a missing value mustn't wipe what yt-dlp found.
+        entry['metadata'] = {**entry['metadata'], **{field: metadata[field] for field in METADATA_FIELDS
+                                                     if metadata.get(field) is not None}}
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate_stream(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry['stream'] = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return {'size': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': round(hit_rate, 3)}
+
+extraction_cache = ExtractionCache(EXTRACT_CACHE_SIZE)
+
+# --- YTDL POOL: Warm YoutubeDL instances, reused across extractions ---
+class YoutubeDLPool:
+    """Reuses YoutubeDL instances per option set (which includes the proxy).
+
+    Constructing one loads every extractor and opens HTTP handlers, so executor threads check
+    an idle instance out instead. YoutubeDL is not thread-safe, so a checkout is exclusive.
+    Instances are recycled once they are too old, too used, or after a failed extraction.
+    """
+
+    def __init__(self, max_idle, max_age, max_uses):
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.max_uses = max_uses
+        self.created = 0
+        self.reused = 0
+        self.recycled = 0
+        self._idle = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(opts):
+        return json.dumps(opts, sort_keys=True, default=str)
+
+    def _acquire(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entries = self._idle.get(key)
+            while entries:
+                entry = entries.pop()
+                if now - entry['created'] < self.max_age:
+                    self.reused += 1
+                    return entry
+                self._discard(entry)
+        self.created += 1
+        return None
+
+    def _release(self, key, entry):
+        with self._lock:
+            self._idle.setdefault(key, []).append(entry)
+            self._idle.move_to_end(key)
+            # Evict from the least recently used option set once over the idle budget.
+            while sum(len(entries) for entries in self._idle.values()) > self.max_idle:
+                oldest_key = next(iter(self._idle))
+                entries = self._idle[oldest_key]
+                self._discard(entries.pop(0))
+                if not entries:
+                    del self._idle[oldest_key]
+
+    def _discard(self, entry):
+        self.recycled += 1
+        try:
+            entry['ydl'].close()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def checkout(self, opts):
+        key = self._key(opts)
+        entry = self._acquire(key)
+        if entry is None:
+            entry = {'ydl': get_yt_dlp().YoutubeDL(opts), 'created': time.monotonic(), 'uses': 0}
+        healthy = False
+        try:
+            yield entry['ydl']
+            healthy = True
+        finally:
+            entry['uses'] += 1
+            if healthy and entry['uses'] < self.max_uses and time.monotonic() - entry['created'] < self.max_age:
+                self._release(key, entry)
+            else:
+                self._discard(entry)
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(entries) for entries in self._idle.values())
+        return {'idle': idle, 'created': self.created, 'reused': self.reused, 'recycled': self.recycled}
+
+ytdl_pool = YoutubeDLPool(YTDL_POOL_MAX_IDLE, YTDL_POOL_MAX_AGE, YTDL_POOL_MAX_USES)
 
 # --- UPDATED EXTRACTOR (Calls get_ytdlp_options every time) ---
-async def extract_info_async(url: str):
-    def blocking():
+# Messages for failures that no proxy can fix, so retrying elsewhere is pointless.
+CONTENT_ERROR_MARKERS = ('Video unavailable', 'Private video', 'This video is', 'removed', 'not available in your country',
+                         'Unsupported URL', 'is not a valid URL', 'Incomplete YouTube ID')
+
+def classify_extraction_error(error):
+    message = str(error)
+    if '403' in message or '429' in message or 'confirm you' in message:
+        return 'blocked'
+    if any(marker in message for marker in CONTENT_ERROR_MARKERS):
+        return 'content'
+    return 'error'
+
+def extract_with_retries(url, extra_opts=None, exclude_proxies=()):
+    """Blocking extraction that retries on a different proxy when one fails or gets blocked."""
+    tried = set(exclude_proxies)
+    for attempt in range(EXTRACT_RETRIES + 1):
         # RE-GENERATE OPTIONS PER REQUEST to pick a new proxy
-        current_opts = get_ytdlp_options()
-        with yt_dlp.YoutubeDL(current_opts) as ydl:
-            return ydl.extract_info(url, download=False)
-    return await asyncio.get_event_loop().run_in_executor(executor, blocking)
+        current_opts = get_ytdlp_options(exclude_proxies=tried)
+        if extra_opts:
+            current_opts.update(extra_opts)
+        proxy = current_opts.get('proxy')
+        started = time.monotonic()
+        try:
+            with ytdl_pool.checkout(current_opts) as ydl:
+                info = ydl.extract_info(url, download=False)
+        except Exception as e:
+            outcome = classify_extraction_error(e)
+            if outcome == 'content':
+                # The proxy answered fine; the video itself is the problem.
+                proxy_manager.record(proxy, 'ok', time.monotonic() - started)
+                raise
+            proxy_manager.record(proxy, outcome)
+            if proxy is None or attempt == EXTRACT_RETRIES:
+                raise
+            tried.add(proxy)
+            print(f"[PROXY] Extraction via {safe_proxy_name(proxy)} failed ({outcome}), retrying on another proxy.")
+            continue
+        proxy_manager.record(proxy, 'ok', time.monotonic() - started)
+        if info is not None:
+            # Signed stream URLs are tied to the IP that resolved them.
+            info['extraction_proxy'] = proxy
+        return info
+
+# --- EXTRACTION PROCESSES: yt-dlp is CPU-bound Python, so it can run outside this interpreter's GIL ---
+class ExtractionError(Exception):
+    """An extraction failure reported by a worker process (yt-dlp's own exceptions don't survive pickling)."""
+
+extraction_processes = None
+
+def get_extraction_processes():
+    global extraction_processes
+    if extraction_processes is None:
+        # spawn, not fork: this process already runs threads (voice, executor, log writer).
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=EXTRACT_PROCESSES,
+                                                      mp_context=multiprocessing.get_context('spawn'))
+        extraction_processes = WorkScheduler('processes', pool, EXTRACT_PROCESSES, EXECUTOR_MAX_BACKLOG)
+        print(f"[INFO] Started {EXTRACT_PROCESSES} extraction processes.")
+    return extraction_processes
+
+def promote_guild_jobs(guild_id):
+    executor.promote(guild_id)
+    if extraction_processes is not None:
+        extraction_processes.promote(guild_id)
+
+def extract_in_worker(url, extra_opts=None, exclude_proxies=(), proxy_health=None):
+    """Runs in an extraction process. Returns (info, error, proxy outcomes) for the main process to replay."""
+    # The main process is the one that knows which proxies are cooling down; a worker only sees its own calls.
+    if proxy_health is not None:
+        proxy_manager.apply_snapshot(proxy_health)
+    proxy_manager.journal = []
+    try:
+        info = extract_with_retries(url, extra_opts, exclude_proxies)
+        # Only plain data can travel back over the pipe.
+        return get_yt_dlp().YoutubeDL.sanitize_info(info), None, proxy_manager.journal
+    except Exception as e:
+        return None, str(e), proxy_manager.journal
+    finally:
+        proxy_manager.journal = None
+
+async def run_extraction(url, extra_opts=None, exclude_proxies=()):
+    """extract_with_retries off the event loop: in a worker process if EXTRACT_PROCESSES is set, else on the executor."""
+    if not EXTRACT_PROCESSES:
+        with metrics.time('extract'):
+            return await executor.run(extract_with_retries, url, extra_opts, exclude_proxies)
+    with metrics.time('extract'):
+        info, error, outcomes = await get_extraction_processes().run(
+            extract_in_worker, url, extra_opts, tuple(exclude_proxies), proxy_manager.snapshot())
+    # Keep this process's proxy health (and /proxies) in step with what the workers saw.
+    for proxy, outcome, latency in outcomes:
+        proxy_manager.record(proxy, outcome, latency)
+    if error is not None:
+        raise ExtractionError(error)
+    return info
+
+async def extract_info_async(url: str, exclude_proxies=()):
+    """Extracts a single track. Cached results are reused while their stream URL is valid."""
+    cache_key = get_cache_key(url)
+    cached = extraction_cache.get(cache_key)
+    metrics.inc('cache_requests_total', cache='extraction', result='miss' if cached is None else 'hit')
+    if cached is not None:
+        return cached
+    # Several guilds playing the same trending track at once trigger one extraction between them.
+    flight_key = (cache_key, tuple(sorted(exclude_proxies)))
+    return await extraction_flights.do(flight_key, lambda: extract_and_cache(url, cache_key, exclude_proxies))
+
+async def extract_and_cache(url, cache_key, exclude_proxies):
+    info = await run_extraction(url, None, exclude_proxies)
+    extraction_cache.put(cache_key, info)
+    return info
+
+# --- PREFETCH: Resolve the next track while the current one plays ---
+# A prefetch entry is {'track', 'task'} plus, in gapless mode, 'stage' (the staging task) and
+# 'staged' ({'source', 'info'}) once the next source is open and buffered.
+def discard_staged(entry):
+    stage = entry.get('stage')
+    if stage and not stage.done():
+        stage.cancel()
+    # Whoever pops 'staged' owns the source; the voice thread may have taken it already.
+    staged = entry.pop('staged', None)
+    if staged:
+        staged['source'].cleanup()
+
+def invalidate_prefetch(player):
+    entry, player.prefetch = player.prefetch, None
+    if not entry:
+        return
+    if entry['task'] and not entry['task'].done():
+        entry['task'].cancel()
+    discard_staged(entry)
+
+def schedule_prefetch(player):
+    """Starts resolving the next track in the background. Safe to call after any queue change."""
+    next_track = player.peek()
+    if player.prefetch and player.prefetch['track'] is next_track:
+        return
+    invalidate_prefetch(player)
+    if next_track is None:
+        return
+    task = None
+    # Tracks in the audio cache start from disk and need no extraction.
+    if not audio_cache.contains(next_track.url):
+        task = background_task(extract_info_async(next_track.url), player.guild_id)
+        # Errors are re-raised to play_next when it awaits the task; silence the "never retrieved" warning.
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    elif not GAPLESS_MODE:
+        return
+    player.prefetch = {'track': next_track, 'task': task}
+    if GAPLESS_MODE:
+        # Opening the next source happens seconds before it plays.
+        with executor_priority(PRIORITY_PLAY, player.guild_id):
+            player.prefetch['stage'] = bot.loop.create_task(stage_next_source(player, player.prefetch))
+
+async def take_prefetched_info(player, track):
+    """Returns the prefetched info for track if it is still usable, otherwise None."""
+    entry, player.prefetch = player.prefetch, None
+    if not entry:
+        return None
+    # play_next is starting the track the slow way, so a half-staged source is no use any more.
+    discard_staged(entry)
+    # The queue head changed since the prefetch started (loop, skip, queue edit).
+    if entry['track'] is not track or entry['task'] is None:
+        if entry['task'] and not entry['task'].done():
+            entry['task'].cancel()
+        return None
+    promote_guild_jobs(player.guild_id)
+    try:
+        info = await entry['task']
+    except asyncio.CancelledError:
+        return None
+    except Exception as e:
+        print(f"[PREFETCH] Prefetch failed for {track.url}, retrying: {e}")
+        return None
+    if 'entries' in info and len(info['entries']) > 0:
+        info = info['entries'][0]
+    if stream_url_expired(info.get('url')):
+        print(f"[PREFETCH] Stream URL for {track.url} expired, re-resolving.")
+        return None
+    return info
+
+# --- GAPLESS: Open and pre-buffer the next source so the voice thread can switch instantly ---
+async def stage_next_source(player, entry):
+    """Waits until the current track is nearly over, then opens and pre-buffers the next one."""
+    track = entry['track']
+    cached_audio = audio_cache.get(track.url)
+    if cached_audio:
+        info = cached_audio['metadata']
+    else:
+        try:
+            info = await entry['task']
+        except Exception:
+            return
+        if 'entries' in info and len(info['entries']) > 0:
+            info = info['entries'][0]
+
+    # Holding a stream open for a whole song invites server-side timeouts; open it near the end.
+    while player.source is not None and player.duration:
+        remaining = player.duration - player.source.position
+        if remaining <= GAPLESS_LEAD_SECONDS:
+            break
+        await asyncio.sleep(min(remaining - GAPLESS_LEAD_SECONDS, 5))
+    if cached_audio:
+        source = PlaybackSource(await spawn_audio_source(open_cached_audio, cached_audio['path']))
+    else:
+        if stream_url_expired(info.get('url')):
+            return
+        source = PlaybackSource(await spawn_audio_source(create_audio_source, info['url'], info.get('acodec')))
+    try:
+        await executor.run(source.prebuffer, GAPLESS_PREBUFFER_FRAMES)
+    except BaseException:
+        source.cleanup()
+        raise
+    if player.prefetch is not entry:
+        source.cleanup()
+        return
+    entry['staged'] = {'source': source, 'info': info}
+
+def start_staged_track(ctx, player):
+    """Called on the voice thread when a track ends: starts the staged source, if any, right away.
+
+    Only vc.play happens here; the queue and player bookkeeping is handed to the event loop.
+    """
+    entry = player.prefetch
+    if not GAPLESS_MODE or entry is None:
+        return False
+    track = entry['track']
+    if player.peek() is not track:
+        return False
+    # Popping the source claims it; discard_staged on the loop pops the same key.
+    staged = entry.pop('staged', None)
+    if staged is None:
+        return False
+    vc = ctx.voice_client
+    if vc is None or not vc.is_connected():
+        staged['source'].cleanup()
+        return False
+    staged['source'].ended_at = player.track_ended_at
+    vc.play(staged['source'], after=lambda e: play_next_callback(ctx, e))
+    started_at = time.monotonic()
+    bot.loop.call_soon_threadsafe(finish_staged_track, ctx, player, entry, track, staged, vc, started_at)
+    return True
+
+def finish_staged_track(ctx, player, entry, track, staged, vc, started_at):
+    """Runs on the event loop right after start_staged_track: moves the queue on to the track already playing."""
+    if player.prefetch is entry:
+        player.prefetch = None
+    if player.peek() is track:
+        player.advance()
+    else:
+        # The queue changed between the voice thread's check and now; the track plays anyway,
+        # so show it as current without taking something else off the queue.
+        player.current = track
+        player.version += 1
+    player.start_track(staged['source'], staged['info'])
+    metrics.inc('tracks_started_total', origin='gapless')
+    bot.loop.create_task(announce_track(ctx, player, track, staged['info'], vc, started_at))
 
 ffmpeg_options = {
     'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
     'options': '-vn'
 }
 
-def log_to_json(file_path, data):
+def create_audio_source(audio_url, acodec=None, start=0):
+    """Opus streams are remuxed with codec copy and sent as-is; anything else is decoded to PCM and re-encoded.
+
+    start seeks the input (in seconds) before decoding, used to resume a track mid-way.
+    """
+    options = dict(ffmpeg_options)
+    if start:
+        options['before_options'] = f"-ss {start:.2f} {options['before_options']}"
+    with metrics.time('ffmpeg_spawn'):
+        if OPUS_PASSTHROUGH and acodec == 'opus':
+            return discord.FFmpegOpusAudio(audio_url, codec='copy', **options)
+        return discord.FFmpegPCMAudio(audio_url, **options)
+
+def open_cached_audio(path, start=0):
+    with metrics.time('ffmpeg_spawn'):
+        return discord.FFmpegOpusAudio(path, codec='copy', before_options=f"-ss {start:.2f}" if start else None, options='-vn')
+
+def _cleanup_orphaned_source(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().cleanup()
+
+async def spawn_audio_source(func, *args, **kwargs):
+    """Runs create_audio_source/open_cached_audio on the executor; spawning ffmpeg from a big process can stall the loop."""
+    future = executor.submit(functools.partial(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # Whoever wanted the source went away (skip, disconnect); don't leak the ffmpeg process.
+        future.add_done_callback(_cleanup_orphaned_source)
+        raise
+
+# Recent inter-track gaps in seconds: previous source ended -> first frame of the next one sent.
+transition_gaps = deque(maxlen=200)
+
+def gap_stats():
+    if not transition_gaps:
+        return {'count': 0}
+    ordered = sorted(transition_gaps)
+    return {'count': len(ordered), 'avg_ms': round(sum(ordered) / len(ordered) * 1000),
+            'p95_ms': round(ordered[int(len(ordered) * 0.95) - 1 if len(ordered) > 1 else 0] * 1000)}
+
+class PlaybackSource(discord.AudioSource):
+    """Wraps an FFmpeg source to pre-buffer frames, track the playback position and time the gap before it."""
+
+    FRAME_SECONDS = 0.02
+
+    def __init__(self, source, start_offset=0.0):
+        self.source = source
+        self.buffer = deque()
+        self.frames = 0
+        self.start_offset = start_offset
+        self.ended_at = None
+
+    @property
+    def position(self):
+        return self.start_offset + self.frames * self.FRAME_SECONDS
+
+    @property
+    def _current_error(self):
+        # discord.py looks for this to report an ffmpeg failure to the after callback.
+        return getattr(self.source, '_current_error', None)
+
+    def prebuffer(self, frames):
+        """Blocks until `frames` frames are buffered (or the stream ends). Run it in the executor."""
+        while len(self.buffer) < frames:
+            data = self.source.read()
+            if not data:
+                break
+            self.buffer.append(data)
+
+    def read(self):
+        data = self.buffer.popleft() if self.buffer else self.source.read()
+        if data:
+            if self.frames == 0 and self.ended_at is not None:
+                gap = time.perf_counter() - self.ended_at
+                transition_gaps.append(gap)
+                print(f"[PLAYER] Inter-track gap: {gap * 1000:.0f} ms")
+            self.frames += 1
+        return data
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.buffer.clear()
+        self.source.cleanup()
+
+# --- AUDIO CACHE: Popular tracks kept on disk as Opus, served without touching YouTube ---
+class AudioCache:
+    """LRU cache of Opus audio files for tracks played at least min_plays times.
+
+    Each track is stored as <hash>.opus plus a <hash>.json sidecar holding its metadata, so a
+    cached track plays without any extraction. A max_bytes of 0 disables the cache.
+    """
+
+    FILL_CONCURRENCY = 2
+    # Uncached tracks whose plays are counted. Past this, the counts are cut to the most played half.
+    MAX_COUNTED = 10000
+
+    def __init__(self, directory, max_bytes, min_plays, max_track_seconds):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.max_track_seconds = max_track_seconds
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # key -> plays, least recently played first
+        self.play_counts = OrderedDict()
+        self.hits = 0
+        self.fills = 0
+        self._filling = set()
+        self._fill_semaphore = None
+        self._loaded = False
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _paths(self, key):
+        name = hashlib.sha1(key.encode()).hexdigest()[:24]
+        return os.path.join(self.directory, f"{name}.opus"), os.path.join(self.directory, f"{name}.json")
+
+    def _load_blocking(self):
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for meta_path in glob.glob(os.path.join(self.directory, "*.json")):
+            audio_path = meta_path[:-5] + ".opus"
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    sidecar = json.load(f)
+                stat = os.stat(audio_path)
+                key, metadata = sidecar['key'], sidecar['metadata']
+            except (OSError, ValueError, KeyError, TypeError):
+                # Unreadable or malformed sidecar: skip it rather than fail the whole load.
+                continue
+            found.append((stat.st_mtime, key, {'path': audio_path, 'size': stat.st_size, 'metadata': metadata}))
+        # Play counts start from the song log, so popular tracks qualify right after a restart.
+        counts = Counter()
+        if os.path.exists(SONG_LOG_FILE):
+            with open(SONG_LOG_FILE, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        url = json.loads(line).get('url')
+                    except ValueError:
+                        continue
+                    if url:
+                        counts[get_cache_key(url)] += 1
+        return sorted(found, key=lambda item: item[0]), counts
+
+    async def load(self):
+        if not self.enabled or self._loaded:
+            return
+        self._loaded = True
+        found, counts = await executor.run(self._load_blocking)
+        for _, key, entry in found:
+            self.entries[key] = entry
+            self.total_bytes += entry['size']
+        # Most played last, so the cap drops one-off plays first.
+        for key, count in reversed(counts.most_common(self.MAX_COUNTED)):
+            if key not in self.entries:
+                self.play_counts[key] = count
+        print(f"[CACHE] {len(self.entries)} tracks ({self.total_bytes / 1048576:.0f} MB) in the audio cache.")
+
+    def contains(self, url):
+        return self.enabled and get_cache_key(url) in self.entries
+
+    def get(self, url):
+        """Returns {'path', 'size', 'metadata'} for a cached track, or None."""
+        if not self.enabled:
+            return None
+        key = get_cache_key(url)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        # Persist recency for the next startup's LRU order.
+        executor.submit(_touch, entry['path'])
+        return entry
+
+    def record_play(self, url, info):
+        """Counts a play and starts caching the track once it crosses the threshold."""
+        if not self.enabled:
+            return
+        key = get_cache_key(url)
+        if key in self.entries:
+            return
+        plays = self.play_counts[key] = self.play_counts.pop(key, 0) + 1
+        if len(self.play_counts) > self.MAX_COUNTED:
+            self._trim_counts()
+        if (plays < self.min_plays or key in self._filling
+                or info.get('acodec') != 'opus' or not info.get('url')
+                or not info.get('duration') or info['duration'] > self.max_track_seconds):
+            return
+        self._filling.add(key)
+        background_task(self._fill(key, info))
+
+    def _trim_counts(self):
+        # Keeps the most played half; between equal counts the more recently played win.
+        ranked = sorted(enumerate(self.play_counts.items()), key=lambda item: (item[1][1], item[0]), reverse=True)
+        self.play_counts = OrderedDict(pair for _, pair in sorted(ranked[:self.MAX_COUNTED // 2]))
+
+    async def _fill(self, key, info):
+        if self._fill_semaphore is None:
+            self._fill_semaphore = asyncio.Semaphore(self.FILL_CONCURRENCY)
+        audio_path, meta_path = self._paths(key)
+        # Sharded processes share the cache directory; keep their partial files apart.
+        part_path = f"{audio_path}.{os.getpid()}.part"
+        try:
+            async with self._fill_semaphore:
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', *shlex.split(ffmpeg_options['before_options']), '-i', info['url'],
+                    '-vn', '-map_metadata', '-1', '-c:a', 'copy', '-f', 'opus', '-loglevel', 'error', '-y', part_path,
+                    stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                _, stderr = await process.communicate()
+            if process.returncode != 0:
+                raise RuntimeError(stderr.decode(errors='replace').strip() or f"ffmpeg exited with {process.returncode}")
+            metadata = {field: info.get(field) for field in METADATA_FIELDS}
+            size = await executor.run(_commit_cache_file, part_path, audio_path, meta_path, {'key': key, 'metadata': metadata})
+        except Exception as e:
+            print(f"[CACHE] Failed to cache {key}: {e}")
+            await executor.run(_remove_files, part_path)
+            return
+        finally:
+            self._filling.discard(key)
+        self.entries[key] = {'path': audio_path, 'size': size, 'metadata': metadata}
+        self.total_bytes += size
+        self.fills += 1
+        # Counting starts over if the track is ever evicted.
+        self.play_counts.pop(key, None)
+        print(f"[CACHE] Cached '{metadata.get('title')}' ({size / 1048576:.1f} MB).")
+        await self._evict()
+
+    async def _evict(self):
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, entry = self.entries.popitem(last=False)
+            self.total_bytes -= entry['size']
+            evicted.extend(self._paths(key))
+        if evicted:
+            await executor.run(_remove_files, *evicted)
+
+    def stats(self):
+        return {'tracks': len(self.entries), 'bytes': self.total_bytes, 'hits': self.hits, 'fills': self.fills}
+
+def _touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def _remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _commit_cache_file(part_path, audio_path, meta_path, sidecar):
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(sidecar, f)
+    os.replace(part_path, audio_path)
+    return os.path.getsize(audio_path)
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_MB * 1024 * 1024, AUDIO_CACHE_MIN_PLAYS, AUDIO_CACHE_MAX_TRACK_SECONDS)
+
+# --- LOGGING: Append-only JSON Lines, written by a background thread ---
+class JsonlLogWriter:
+    """Buffers log entries and appends them in batches, rotating files by size and age."""
+
+    BATCH_SIZE = 500
+
+    def __init__(self, flush_interval, max_bytes, rotate_seconds):
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.queue = Queue()
+        self._thread = None
+        self._started_at = {}
+
+    def write(self, file_path, entry):
+        """Queues an entry and returns immediately."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+        self.queue.put((file_path, entry))
+
+    def close(self):
+        """Flushes everything queued so far. Registered with atexit."""
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(timeout=10)
+
+    def _run(self):
+        for legacy_path, jsonl_path in LEGACY_LOG_FILES.items():
+            try:
+                migrate_json_log(legacy_path, jsonl_path)
+            except Exception as e:
+                print(f"[ERROR] Failed to migrate {legacy_path}: {e}")
+        while True:
+            item = self.queue.get()
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while item is not None:
+                batch.append(item)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.BATCH_SIZE or remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except Empty:
+                    break
+            self._flush(batch)
+            if item is None:
+                return
+
+    def _flush(self, batch):
+        lines_by_file = {}
+        for file_path, entry in batch:
+            lines_by_file.setdefault(file_path, []).append(json.dumps(entry, ensure_ascii=False) + "\n")
+        for file_path, lines in lines_by_file.items():
+            try:
+                self._rotate_if_needed(file_path)
+                with open(file_path, 'a', encoding='utf-8') as f:
+                    f.writelines(lines)
+            except OSError as e:
+                print(f"[ERROR] Failed to write {file_path}: {e}")
+
+    def _rotate_if_needed(self, file_path):
+        if not os.path.exists(file_path):
+            self._started_at[file_path] = time.time()
+            return
+        if file_path not in self._started_at:
+            self._started_at[file_path] = get_log_start_time(file_path)
+        too_big = os.path.getsize(file_path) >= self.max_bytes
+        too_old = time.time() - self._started_at[file_path] >= self.rotate_seconds
+        if too_big or too_old:
+            base, ext = os.path.splitext(file_path)
+            os.replace(file_path, f"{base}.{datetime.now().strftime('%Y%m%d-%H%M%S')}{ext}")
+            self._started_at[file_path] = time.time()
+
+def get_log_start_time(file_path):
+    """Timestamp of the first entry in a JSON Lines log, falling back to the file's mtime."""
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
-            log_list = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        log_list = []
-    log_list.append(data)
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(log_list, f, indent=4)
+            return datetime.fromisoformat(json.loads(f.readline())['timestamp']).timestamp()
+    except (OSError, ValueError, KeyError, TypeError):
+        return os.path.getmtime(file_path)
+
+def migrate_json_log(legacy_path, jsonl_path):
+    """Converts a JSON-array log into JSON Lines (prepended to any existing lines) and renames the original."""
+    if not os.path.exists(legacy_path):
+        return
+    with open(legacy_path, 'r', encoding='utf-8') as f:
+        try:
+            entries = json.load(f)
+        except json.JSONDecodeError:
+            entries = []
+    tmp_path = jsonl_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as out:
+        for entry in entries:
+            out.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        if os.path.exists(jsonl_path):
+            with open(jsonl_path, 'r', encoding='utf-8') as existing:
+                shutil.copyfileobj(existing, out)
+    os.replace(tmp_path, jsonl_path)
+    os.replace(legacy_path, legacy_path + ".migrated")
+    print(f"[INFO] Migrated {len(entries)} entries from {legacy_path} to {jsonl_path}.")
+
+log_writer = JsonlLogWriter(LOG_FLUSH_INTERVAL, LOG_MAX_BYTES, LOG_ROTATE_SECONDS)
+atexit.register(log_writer.close)
 
 def log_song(song_data):
     log_entry = {
@@ -183,7 +1847,7 @@ def log_song(song_data):
         'requester_id': song_data.get('requester_id'),
     }
     print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] SONG: '{log_entry['title']}' requested by {log_entry['requester_name']} in '{log_entry['guild_name']}'")
-    log_to_json(SONG_LOG_FILE, log_entry)
+    log_writer.write(SONG_LOG_FILE, log_entry)
 
 def log_event(event_data):
     log_entry = {
@@ -195,7 +1859,7 @@ def log_event(event_data):
         'user_id': event_data.get('user_id'),
     }
     print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] EVENT: {log_entry['user_name']} triggered {log_entry['event_type']} in '{log_entry['guild_name']}'")
-    log_to_json(EVENT_LOG_FILE, log_entry)
+    log_writer.write(EVENT_LOG_FILE, log_entry)
 
 def create_progress_bar(current_sec, total_sec, bar_length=20):
     if total_sec is None or total_sec == 0:
@@ -211,240 +1875,1420 @@ def format_time(seconds):
     minutes, seconds = divmod(seconds, 60)
     return f"{int(minutes):02}:{int(seconds):02}"
 
-async def extract_title(url: str):
-    try:
-        info = await extract_info_async(url)
-        if 'entries' in info and info.get('_type') == 'playlist' and info.get('entries'):
-            return info['entries'][0].get('title', url)
-        return info.get('title', url)
-    except Exception:
-        return url
-
 YOUTUBE_URL_REGEX = re.compile(r"(https?://)?(www\.)?(youtube\.com|youtu\.be)/.+")
 SOUNDCLOUD_URL_REGEX = re.compile(r"https?://(www\.)?soundcloud\.com/.+")
 SPOTIFY_URL_REGEX = re.compile(r"https://open\.spotify\.com/(track|album|playlist)/[a-zA-Z0-9]+")
 
+# --- HTTP: One pooled session shared by all API calls ---
+http_session = None
+
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max(10, SPOTIFY_RESOLVE_CONCURRENCY * 2)))
+    return http_session
+
+class RateLimiter:
+    """Spaces calls out so that at most `rate` start per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next_slot = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        wait = self._next_slot - now
+        self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+youtube_api_limiter = RateLimiter(YOUTUBE_API_RATE)
+
+# --- SEARCH CACHE: Persistent query -> videoId mapping (saves API quota) ---
+SEARCH_CACHE_MISS = object()
+
+def normalize_query(query):
+    """Folds case, unicode forms and whitespace so equivalent queries share one cache entry."""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+class SearchCache:
+    """sqlite-backed cache of YouTube search results, with the most recently used ones kept in memory.
+
+    A video_id of None records a search that returned nothing (negative cache).
+    """
+
+    def __init__(self, path, ttl, negative_ttl, max_size):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._load_lock = None
+
+    def _is_fresh(self, video_id, created):
+        ttl = self.ttl if video_id else self.negative_ttl
+        return created + ttl > time.time()
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def _load_blocking(self):
+        with self._db_lock:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS searches (query TEXT PRIMARY KEY, video_id TEXT, created REAL NOT NULL)")
+            now = time.time()
+            self._conn.execute("DELETE FROM searches WHERE created <= ? - (CASE WHEN video_id IS NULL THEN ? ELSE ? END)",
+                               (now, self.negative_ttl, self.ttl))
+            self._conn.commit()
+            # Warm the memory copy with the newest searches; older ones are read from disk on a miss.
+            rows = self._conn.execute("SELECT query, video_id, created FROM searches ORDER BY created DESC LIMIT ?",
+                                      (self.max_size,)).fetchall()
+        return [(query, (video_id, created)) for query, video_id, created in reversed(rows)]
+
+    def _fetch_blocking(self, key):
+        with self._db_lock:
+            return self._conn.execute("SELECT video_id, created FROM searches WHERE query = ?", (key,)).fetchone()
+
+    def _store_blocking(self, query, video_id, created):
+        with self._db_lock:
+            self._conn.execute("INSERT OR REPLACE INTO searches VALUES (?, ?, ?)", (query, video_id, created))
+            self._conn.commit()
+
+    async def load(self):
+        """Opens the database off the event loop. Safe to call repeatedly."""
+        if self._conn is not None:
+            return
+        if self._load_lock is None:
+            self._load_lock = asyncio.Lock()
+        async with self._load_lock:
+            if self._conn is not None:
+                return
+            try:
+                rows = await executor.run(self._load_blocking)
+            except sqlite3.Error as e:
+                print(f"[ERROR] Failed to open search cache {self.path}: {e}")
+                return
+            # Anything stored while loading is newer than what is on disk.
+            stored, self.entries = self.entries, OrderedDict()
+            for key, entry in rows:
+                self._remember(key, entry)
+            for key, entry in stored.items():
+                self._remember(key, entry)
+            print(f"[INFO] Search cache ready, {len(self.entries)} recent searches in memory.")
+
+    async def get(self, query):
+        """Returns the cached video ID (None for a cached empty result) or SEARCH_CACHE_MISS."""
+        await self.load()
+        key = normalize_query(query)
+        entry = self.entries.get(key)
+        if entry is None and self._conn is not None:
+            try:
+                entry = await executor.run(self._fetch_blocking, key)
+            except sqlite3.Error as e:
+                print(f"[ERROR] Failed to read search cache: {e}")
+        if entry is not None:
+            if self._is_fresh(*entry):
+                self._remember(key, tuple(entry))
+                self.hits += 1
+                return entry[0]
+            # Stale: the fresh result put() stores next replaces the row on disk.
+            self.entries.pop(key, None)
+        self.misses += 1
+        return SEARCH_CACHE_MISS
+
+    async def put(self, query, video_id):
+        key = normalize_query(query)
+        created = time.time()
+        self._remember(key, (video_id, created))
+        if self._conn is None:
+            return
+        try:
+            await executor.run(self._store_blocking, key, video_id, created)
+        except sqlite3.Error as e:
+            print(f"[ERROR] Failed to persist search cache entry: {e}")
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+search_cache = SearchCache(SEARCH_CACHE_FILE, SEARCH_CACHE_TTL, SEARCH_CACHE_NEGATIVE_TTL, SEARCH_CACHE_MEMORY_SIZE)
+
+# --- WARM RESTART: Player state snapshots, restored lazily after a restart ---
+def capture_player(player):
+    """Copies what a snapshot needs. Runs on the loop, so it only copies references; encoding happens off-loop."""
+    history = list(player.history)
+    current, replay_index = player.current, player.replay_index
+    if replay_index is not None:
+        # A replayed track stays in history; resuming replays it from there.
+        if current is not None and replay_index > 0 and history[replay_index - 1] is current:
+            replay_index -= 1
+        current = None
+    # play_next appends the current track to history as it starts; it's saved separately.
+    elif history and history[-1] is current:
+        history.pop()
+    return {'loop_song': player.loop_song, 'loop_queue': player.loop_queue, 'current': current,
+            'queue': list(player.queue), 'history': history, 'replay_index': replay_index}
+
+def encode_player_state(captured):
+    """JSON with requesters stored once and tracks as [url, title, requester index, duration, thumbnail]."""
+    requesters = {}
+
+    def requester_index(requester):
+        if requester.id not in requesters:
+            requesters[requester.id] = (len(requesters), [requester.id, requester.name, requester.mention])
+        return requesters[requester.id][0]
+
+    def row(track):
+        return [track.url, track.title, requester_index(track.requester), track.duration, track.thumbnail]
+
+    def queue_row(item):
+        if isinstance(item, PlaylistStream):
+            # Only where to pick the playlist up again; its entries are fetched anew.
+            return {'playlist': item.url, 'title': item.title, 'total': item.total, 'pulled': item.pulled,
+                    'requester': requester_index(item.requester)}
+        return row(item)
+
+    state = {'loop_song': captured['loop_song'], 'loop_queue': captured['loop_queue'],
+             'current': row(captured['current']) if captured['current'] else None,
+             'queue': [queue_row(item) for item in captured['queue']],
+             'history': [row(track) for track in captured['history']], 'replay_index': captured['replay_index']}
+    state['requesters'] = [entry for _, entry in sorted(requesters.values(), key=lambda item: item[0])]
+    return json.dumps(state, ensure_ascii=False, separators=(',', ':'))
+
+def decode_player_state(guild_id, text):
+    state = json.loads(text)
+    requesters = [intern_requester(*entry) for entry in state['requesters']]
+
+    def track(row):
+        url, title, requester_index, duration, thumbnail = row
+        return Track(url, title, requesters[requester_index], duration, thumbnail)
+
+    def queue_item(row):
+        if isinstance(row, dict):
+            return PlaylistStream(row['playlist'], requesters[row['requester']], row['title'], row['total'], row['pulled'])
+        return track(row)
+
+    player = GuildPlayer(guild_id)
+    player.loop_song = state['loop_song']
+    player.loop_queue = state['loop_queue']
+    player.history.extend(track(row) for row in state['history'])
+    # Older history beyond HISTORY_LIMIT may have been dropped just now.
+    replay_index = state.get('replay_index')
+    if replay_index is not None:
+        player.replay_index = max(0, replay_index - (len(state['history']) - len(player.history)))
+    player.queue.extend(queue_item(row) for row in state['queue'])
+    # The interrupted track plays again first.
+    if state['current']:
+        player.queue.appendleft(track(state['current']))
+    return player
+
+class ChannelContext:
+    """Stands in for the /play context when the bot resumes a guild on its own after a restart."""
+
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+class PlayerStateStore:
+    """sqlite snapshots of every guild's queue, history, loop flags, channels and position.
+
+    Snapshots are incremental: only guilds whose player version or channels changed are
+    re-encoded, and playing guilds otherwise just get their position updated. At startup rows
+    are read as raw JSON and only decoded when a guild is first used (or rejoined).
+    """
+
+    def __init__(self, path, interval, max_age):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        # guild_id -> (state JSON, position, voice channel id, text channel id), not yet restored
+        self.saved = {}
+        # guild_id -> (player version, voice channel id, text channel id) last written
+        self.written = {}
+        self.positions = {}
+        self.forgotten = set()
+        self.loaded_at = None
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._task = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS players (guild_id INTEGER PRIMARY KEY, state TEXT NOT NULL, "
+                               "position REAL, voice_channel INTEGER, text_channel INTEGER, updated REAL NOT NULL)")
+        return self._conn
+
+    def _load_blocking(self):
+        with self._db_lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM players WHERE updated < ?", (time.time() - self.max_age,))
+            conn.commit()
+            return conn.execute("SELECT guild_id, state, position, voice_channel, text_channel FROM players").fetchall()
+
+    async def load(self):
+        """Reads saved state and starts the snapshot task. Safe to call repeatedly."""
+        if not self.enabled or self._task is not None:
+            return
+        self._task = background_task(self._run())
+        started = time.perf_counter()
+        try:
+            rows = await executor.run(self._load_blocking)
+        except sqlite3.Error as e:
+            print(f"[ERROR] Could not load {self.path}: {e}")
+            return
+        for guild_id, state, position, voice_channel, text_channel in rows:
+            # A guild that started playing while we were loading keeps its new state.
+            if guild_id not in players and guild_id not in self.forgotten:
+                self.saved[guild_id] = (state, position or 0.0, voice_channel, text_channel)
+        self.loaded_at = time.monotonic()
+        print(f"[RESTORE] Loaded saved state for {len(self.saved)} guilds in {(time.perf_counter() - started) * 1000:.0f} ms.")
+        if RESTORE_REJOIN:
+            await self.rejoin_all()
+
+    def restore(self, guild_id):
+        """Builds a guild's player from its snapshot, or returns None."""
+        saved = self.saved.pop(guild_id, None)
+        if saved is None:
+            return None
+        try:
+            player = decode_player_state(guild_id, saved[0])
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            print(f"[ERROR] Discarding unreadable saved state for guild {guild_id}: {e}")
+            return None
+        self.written[guild_id] = (player.version, saved[2], saved[3])
+        self.positions[guild_id] = saved[1]
+        print(f"[RESTORE] Restored {len(player.queue)} queued tracks for guild {guild_id}.")
+        return player
+
+    def drop_stale(self):
+        """Snapshots nobody picked up within max_age of loading them would be too old to restore anyway."""
+        if self.saved and self.loaded_at is not None and time.monotonic() - self.loaded_at > self.max_age:
+            print(f"[RESTORE] Dropping {len(self.saved)} saved states that were never resumed.")
+            self.saved.clear()
+
+    def forget(self, guild_id):
+        """The guild was disconnected on purpose; its snapshot shouldn't come back."""
+        self.saved.pop(guild_id, None)
+        if self.enabled:
+            self.forgotten.add(guild_id)
+
+    async def rejoin_all(self):
+        candidates = [(guild_id, saved[1], saved[2], saved[3]) for guild_id, saved in self.saved.items() if saved[2]]
+        semaphore = asyncio.Semaphore(5)
+
+        async def rejoin(guild_id, position, voice_id, text_id):
+            async with semaphore:
+                try:
+                    await self._rejoin_guild(guild_id, position, voice_id, text_id)
+                except Exception as e:
+                    print(f"[RESTORE] Could not resume guild {guild_id}: {e}")
+
+        await asyncio.gather(*(rejoin(*candidate) for candidate in candidates))
+
+    async def _rejoin_guild(self, guild_id, position, voice_id, text_id):
+        guild = bot.get_guild(guild_id)
+        # Guilds on other shards (or that removed the bot) are left alone.
+        if guild is None or guild.voice_client is not None:
+            return
+        channel = guild.get_channel(voice_id)
+        text_channel = guild.get_channel(text_id) if text_id else None
+        if channel is None or text_channel is None or not any(not member.bot for member in channel.members):
+            return
+        player = get_player(guild_id)
+        if not player.queue:
+            return
+        await channel.connect()
+        player.ctx = ChannelContext(guild, text_channel)
+        print(f"[RESTORE] Rejoined '{channel.name}' in '{guild.name}', resuming at {format_time(position)}.")
+        # Back up a little so the listener hears where they were.
+        await play_next(player.ctx, start=max(0.0, position - 2))
+
+    def _collect(self, final=False):
+        """Runs on the loop. Returns (full snapshots, position updates, deletes) for guilds that changed."""
+        full, positions, deletes = [], [], []
+        for guild_id, player in list(players.items()):
+            if player.current is None and not player.queue and not player.history:
+                # The queue ran out; there is nothing to come back to.
+                if guild_id in self.written:
+                    deletes.append(guild_id)
+                continue
+            vc = player.ctx.guild.voice_client if player.ctx is not None else None
+            voice_id = vc.channel.id if vc is not None and vc.channel is not None else None
+            text_id = getattr(getattr(player.ctx, 'channel', None), 'id', None)
+            previous = self.written.get(guild_id)
+            if final and voice_id is None and previous is not None:
+                # Shutting down has already closed voice; keep the channel we were in.
+                voice_id = previous[1]
+            if player.suspended_at is not None:
+                position = player.suspended_at
+            elif player.source is not None and player.current is not None:
+                position = player.source.position
+            else:
+                position = self.positions.get(guild_id, 0.0)
+            marker = (player.version, voice_id, text_id)
+            if previous != marker:
+                full.append((guild_id, capture_player(player), position, voice_id, text_id))
+                self.written[guild_id] = marker
+                self.positions[guild_id] = position
+            elif abs(position - self.positions.get(guild_id, 0.0)) >= 1:
+                positions.append((position, time.time(), guild_id))
+                self.positions[guild_id] = position
+        deletes = set(deletes).union(guild_id for guild_id in self.written if guild_id not in players).union(self.forgotten)
+        for guild_id in deletes:
+            self.written.pop(guild_id, None)
+            self.positions.pop(guild_id, None)
+        self.forgotten.clear()
+        return full, positions, deletes
+
+    def _write_blocking(self, full, positions, deletes):
+        now = time.time()
+        rows = [(guild_id, encode_player_state(captured), position, voice_id, text_id, now)
+                for guild_id, captured, position, voice_id, text_id in full]
+        with self._db_lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR REPLACE INTO players VALUES (?, ?, ?, ?, ?, ?)", rows)
+            conn.executemany("UPDATE players SET position = ?, updated = ? WHERE guild_id = ?", positions)
+            conn.executemany("DELETE FROM players WHERE guild_id = ?", [(guild_id,) for guild_id in deletes])
+            conn.commit()
+
+    async def snapshot(self):
+        full, positions, deletes = self._collect()
+        if full or positions or deletes:
+            with metrics.time('player_snapshot'):
+                await executor.run(self._write_blocking, full, positions, deletes)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.snapshot()
+            except Exception as e:
+                print(f"[ERROR] Player snapshot failed: {e}")
+
+    def close(self):
+        """Final snapshot at exit. Registered with atexit."""
+        if self._task is None:
+            return
+        try:
+            self._write_blocking(*self._collect(final=True))
+        except Exception as e:
+            print(f"[ERROR] Final player snapshot failed: {e}")
+
+player_store = PlayerStateStore(PLAYER_STATE_FILE, PLAYER_SNAPSHOT_INTERVAL, PLAYER_STATE_MAX_AGE)
+atexit.register(player_store.close)
+
 async def search_youtube_video(query):
-    async with aiohttp.ClientSession() as session:
-        params = {"part": "snippet", "q": query, "type": "video", "maxResults": 1, "key": YOUTUBE_API_KEY}
-        async with session.get("https://www.googleapis.com/youtube/v3/search", params=params) as resp:
+    video_id = await search_cache.get(query)
+    metrics.inc('cache_requests_total', cache='search', result='miss' if video_id is SEARCH_CACHE_MISS else 'hit')
+    if video_id is SEARCH_CACHE_MISS:
+        video_id = await search_flights.do(normalize_query(query), lambda: fetch_youtube_search(query))
+    if video_id:
+        return f"https://www.youtube.com/watch?v={video_id}"
+    return None
+
+async def fetch_youtube_search(query):
+    """One YouTube Data API search. Returns the top video ID, or None."""
+    with metrics.time('youtube_api_wait'):
+        await youtube_api_limiter.acquire()
+    params = {"part": "snippet", "q": query, "type": "video", "maxResults": 1, "key": YOUTUBE_API_KEY}
+    with metrics.time('youtube_search'):
+        async with get_http_session().get("https://www.googleapis.com/youtube/v3/search", params=params) as resp:
             data = await resp.json()
-            if "items" in data and data["items"]:
-                video_id = data["items"][0]["id"]["videoId"]
-                return f"https://www.youtube.com/watch?v={video_id}"
-            return None
+    # Only a successful response is cached; quota/API errors come back without "items".
+    if "items" not in data:
+        return None
+    video_id = data["items"][0]["id"]["videoId"] if data["items"] else None
+    await search_cache.put(query, video_id)
+    return video_id
         
+# --- METADATA: Titles, durations and thumbnails from videos.list, 50 IDs per API call ---
+ISO_DURATION_REGEX = re.compile(r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+
+def parse_iso_duration(value):
+    """'PT4M13S' -> 253. Live streams report P0D, which comes back as None."""
+    match = ISO_DURATION_REGEX.match(value or "")
+    if not match:
+        return None
+    days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return (days * 86400 + hours * 3600 + minutes * 60 + seconds) or None
+
+def get_youtube_video_id(url):
+    match = YOUTUBE_ID_REGEX.search(url)
+    return match.group(1) if match else None
+
+class VideoMetadataService:
+    """Looks up video metadata through the YouTube Data API without touching yt-dlp.
+
+    Lookups requested within BATCH_DELAY of each other share videos.list calls of up to 50 IDs
+    (1 quota unit each, against 100 for a search). Results land in the extraction cache as
+    metadata-only entries.
+    """
+
+    BATCH_SIZE = 50
+    BATCH_DELAY = 0.05
+
+    def __init__(self):
+        self.pending = {}
+        self.calls = 0
+        self._flush_task = None
+
+    async def get(self, video_id):
+        """{'id', 'title', 'duration', 'thumbnail', 'uploader', ...} or None if the video isn't available."""
+        cached = extraction_cache.get_metadata(f"youtube:{video_id}")
+        if cached is not None and cached.get('title'):
+            return cached
+        future = self.pending.get(video_id)
+        if future is None:
+            future = self.pending[video_id] = asyncio.get_event_loop().create_future()
+            if self._flush_task is None:
+                self._flush_task = bot.loop.create_task(self._flush())
+        return await asyncio.shield(future)
+
+    async def get_many(self, video_ids):
+        return await asyncio.gather(*(self.get(video_id) for video_id in video_ids))
+
+    async def _flush(self):
+        await asyncio.sleep(self.BATCH_DELAY)
+        self._flush_task = None
+        batch_ids = list(self.pending)
+        for start in range(0, len(batch_ids), self.BATCH_SIZE):
+            batch = {video_id: self.pending.pop(video_id) for video_id in batch_ids[start:start + self.BATCH_SIZE]}
+            bot.loop.create_task(self._fetch(batch))
+
+    async def _fetch(self, batch):
+        items = {}
+        try:
+            if YOUTUBE_API_KEY:
+                await youtube_api_limiter.acquire()
+                params = {"part": "snippet,contentDetails", "id": ",".join(batch), "key": YOUTUBE_API_KEY,
+                          "maxResults": self.BATCH_SIZE}
+                with metrics.time('youtube_videos_list'):
+                    async with get_http_session().get("https://www.googleapis.com/youtube/v3/videos", params=params) as resp:
+                        data = await resp.json()
+                self.calls += 1
+                if "items" not in data:
+                    print(f"[ERROR] videos.list failed: {data.get('error', {}).get('message', data)}")
+                items = {item['id']: item for item in data.get('items', [])}
+        except Exception as e:
+            print(f"[ERROR] videos.list failed: {e}")
+        for video_id, future in batch.items():
+            metadata = self._parse(items[video_id]) if video_id in items else None
+            if metadata is not None:
+                extraction_cache.put_metadata(f"youtube:{video_id}", metadata)
+            if not future.done():
+                future.set_result(metadata)
+
+    @staticmethod
+    def _parse(item):
+        snippet = item.get('snippet', {})
+        thumbnails = snippet.get('thumbnails', {})
+        thumbnail = next((thumbnails[size]['url'] for size in ('maxres', 'high', 'medium', 'default') if size in thumbnails), None)
+        url = f"https://www.youtube.com/watch?v={item['id']}"
+        live = snippet.get('liveBroadcastContent') == 'live'
+        return {'id': item['id'], 'title': snippet.get('title'), 'uploader': snippet.get('channelTitle'),
+                'duration': None if live else parse_iso_duration(item.get('contentDetails', {}).get('duration')),
+                'thumbnail': thumbnail, 'webpage_url': url, 'original_url': url}
+
+metadata_service = VideoMetadataService()
+
+async def fill_track_metadata(tracks, keep_titles=False):
+    """Sets title (unless keep_titles), duration and thumbnail on queued YouTube tracks, in batches."""
+    tracks = [track for track in tracks if get_youtube_video_id(track.url)]
+    results = await metadata_service.get_many([get_youtube_video_id(track.url) for track in tracks])
+    for track, metadata in zip(tracks, results):
+        if metadata is None:
+            continue
+        if metadata.get('title') and not keep_titles:
+            track.title = metadata['title']
+        track.duration = track.duration or metadata.get('duration')
+        track.thumbnail = track.thumbnail or metadata.get('thumbnail')
+
+# --- SPOTIFY: Metadata lookups run in the executor so pagination never blocks the loop ---
+SPOTIFY_PAGE_CONCURRENCY = 4
+SPOTIFY_CACHE_SIZE = 256
+# key -> (snapshot_id, result). Albums are immutable, so their snapshot is None.
+spotify_cache = OrderedDict()
+
+def spotify_track_query(track):
+    return f"{track['name']} {track['artists'][0]['name']} audio"
+
+def spotify_cache_get(key, snapshot=None):
+    entry = spotify_cache.get(key)
+    if entry is None or entry[0] != snapshot:
+        return None
+    spotify_cache.move_to_end(key)
+    result = entry[1]
+    # Callers consume the list (play pops the first track), so hand out a copy.
+    return list(result) if isinstance(result, list) else result
+
+def spotify_cache_put(key, snapshot, result):
+    spotify_cache[key] = (snapshot, result)
+    spotify_cache.move_to_end(key)
+    while len(spotify_cache) > SPOTIFY_CACHE_SIZE:
+        spotify_cache.popitem(last=False)
+
+async def run_spotify(func, *args, **kwargs):
+    return await executor.run(functools.partial(func, *args, **kwargs))
+
+async def fetch_spotify_items(fetch_page, page_size):
+    """Fetches the first page to learn the total, then the remaining pages concurrently, in order."""
+    first_page = await run_spotify(fetch_page, limit=page_size, offset=0)
+    semaphore = asyncio.Semaphore(SPOTIFY_PAGE_CONCURRENCY)
+
+    async def fetch(offset):
+        async with semaphore:
+            page = await run_spotify(fetch_page, limit=page_size, offset=offset)
+            return page['items']
+
+    pages = await asyncio.gather(*(fetch(offset) for offset in range(page_size, first_page.get('total') or 0, page_size)))
+    items = list(first_page['items'])
+    for page_items in pages:
+        items.extend(page_items)
+    return items
+
+@metrics.timed('spotify_lookup')
 async def get_spotify_track_info(spotify_url):
     try:
+        # The first call imports spotipy and builds the client; keep that off the event loop.
+        sp = await run_spotify(get_spotify)
         if "track" in spotify_url:
             track_id = spotify_url.split('/')[-1].split('?')[0]
-            track = sp.track(track_id)
-            return f"{track['name']} {track['artists'][0]['name']} audio"
+            cached = spotify_cache_get(f"track:{track_id}")
+            if cached is not None:
+                return cached
+            track = await run_spotify(sp.track, track_id)
+            query = spotify_track_query(track)
+            spotify_cache_put(f"track:{track_id}", None, query)
+            return query
             
         elif "album" in spotify_url:
             album_id = spotify_url.split('/')[-1].split('?')[0]
-            album_tracks = sp.album_tracks(album_id)
-            return [f"{item['name']} {item['artists'][0]['name']} audio" for item in album_tracks['items']]
+            cached = spotify_cache_get(f"album:{album_id}")
+            if cached is not None:
+                return cached
+            items = await fetch_spotify_items(functools.partial(sp.album_tracks, album_id), 50)
+            track_list = [spotify_track_query(item) for item in items if item.get('name') and item.get('artists')]
+            spotify_cache_put(f"album:{album_id}", None, track_list)
+            return list(track_list)
 
         elif "playlist" in spotify_url:
             playlist_id = spotify_url.split('/')[-1].split('?')[0]
+            # The snapshot ID changes whenever the playlist is edited, so it validates the cached track list.
+            playlist = await run_spotify(sp.playlist, playlist_id, fields="snapshot_id")
+            snapshot_id = playlist.get('snapshot_id')
+            cached = spotify_cache_get(f"playlist:{playlist_id}", snapshot_id)
+            if cached is not None:
+                return cached
+            fetch_page = functools.partial(sp.playlist_items, playlist_id, fields="items(track(name,artists(name))),total")
+            items = await fetch_spotify_items(fetch_page, 100)
             track_list = []
-            response = sp.playlist_items(playlist_id)
-            while True:
-                for item in response['items']:
-                    if item.get('track') and item['track'].get('name') and item['track'].get('artists'):
-                        track = item['track']
-                        track_list.append(f"{track['name']} {track['artists'][0]['name']} audio")
-                if response['next']:
-                    response = sp.next(response)
-                else:
-                    break
-            return track_list
+            for item in items:
+                if item.get('track') and item['track'].get('name') and item['track'].get('artists'):
+                    track_list.append(spotify_track_query(item['track']))
+            spotify_cache_put(f"playlist:{playlist_id}", snapshot_id, track_list)
+            return list(track_list)
     except Exception as e:
         print(f"[ERROR] Could not get Spotify track info for {spotify_url}: {e}")
     return None
 
+def should_resume(player, source, error):
+    """True when a track stopped on its own before its end: an expired URL, a mid-stream 403, a dropped connection."""
+    if player.current is None or player.resume_attempts >= RESUME_MAX_ATTEMPTS:
+        return False
+    if error is not None:
+        return True
+    return bool(player.duration) and source.position < player.duration - RESUME_TOLERANCE_SECONDS
+
 def play_next_callback(ctx, error):
+    # Runs on the voice thread, so everything touching the loop goes through run_coroutine_threadsafe.
+    player = players.get(ctx.guild.id)
+    # The guild was disconnected and its state discarded; nothing to continue.
+    if player is None:
+        return
+    # The idle policy stopped the source; the session continues when someone comes back.
+    if player.releasing:
+        player.releasing = False
+        return
+    source, player.source = player.source, None
+    skipped, player.skipping = player.skipping, False
+    if not skipped and source is not None and should_resume(player, source, error):
+        player.resuming = True
+        asyncio.run_coroutine_threadsafe(resume_track(ctx, player, player.current, source.position, error), bot.loop)
+        return
+    player.track_ended_at = time.perf_counter()
     if error:
         print(f"[DEBUG] Player error: {error}")
-        bot.loop.create_task(ctx.send(f"Playback error: {error}"))
-    
-    guild_id = ctx.guild.id
-    
-    if loop_states.get(guild_id, False):
-        song_to_loop = current_song_info.get(guild_id)
-        if song_to_loop:
-            music_queues.setdefault(guild_id, []).insert(0, song_to_loop)
-
-    bot.loop.create_task(play_next(ctx))
+        asyncio.run_coroutine_threadsafe(ctx.send(f"Playback error: {error}"), bot.loop)
+        # Don't hand the same (possibly expired/blocked) stream URL out again.
+        if player.current:
+            extraction_cache.invalidate_stream(get_cache_key(player.current.url))
 
-
-async def update_progress_task(ctx, now_playing_msg, title, duration, song_start_time, vc, embed_template, view):
+    if start_staged_track(ctx, player):
+        return
+    asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
+
+async def resume_track(ctx, player, track, position, error):
+    """Re-resolves a failed stream (avoiding the proxy that resolved it) and continues from `position`."""
+    # Started from the voice thread as a task of its own, so this doesn't leak anywhere.
+    executor_context.set((PRIORITY_PLAY, player.guild_id))
+    player.resume_attempts += 1
+    metrics.inc('stream_resumes_total')
+    # Live streams have no meaningful position; rejoin them at the live edge.
+    start = position if player.duration else 0
+    print(f"[PLAYER] Stream for '{track.title}' stopped at {format_time(position)} ({error or 'ended early'}), "
+          f"re-resolving (attempt {player.resume_attempts}/{RESUME_MAX_ATTEMPTS}).")
+    extraction_cache.invalidate_stream(get_cache_key(track.url))
+    failed_proxy = player.stream_proxy
+    source = None
     try:
-        original_message_id = now_playing_msg.id
-        while vc.is_playing() and vc.source and current_playing_messages.get(ctx.guild.id) and current_playing_messages[ctx.guild.id].id == original_message_id:
-            elapsed = int(time.monotonic() - song_start_time)
-            if duration is not None and duration > 0 and elapsed >= duration + 2:
-                break
-            
-            progress = create_progress_bar(elapsed, duration)
-            current_embed = embed_template.copy()
-            
-            original_description_lines = embed_template.description.split('\n')
-            progress_line_start_index = -1
-            for i, line in enumerate(original_description_lines):
-                if '`' in line and '/' in line:
-                    progress_line_start_index = i
-                    break
-            
-            if progress_line_start_index != -1:
-                static_info_part = "\n".join(original_description_lines[:progress_line_start_index])
-                current_embed.description = (f"{static_info_part}\n\n" f"`{format_time(elapsed)} / {format_time(duration)}`\n{progress}")
-            
+        info = await extract_info_async(track.url, exclude_proxies=(failed_proxy,) if failed_proxy else ())
+        if 'entries' in info and len(info['entries']) > 0:
+            info = info['entries'][0]
+        source = PlaybackSource(await spawn_audio_source(create_audio_source, info['url'], info.get('acodec'), start=start),
+                                start_offset=start)
+        vc = ctx.voice_client
+        # Skipped, disconnected or replaced while we were resolving.
+        if players.get(player.guild_id) is not player or player.current is not track or vc is None \
+                or not vc.is_connected() or vc.is_playing() or vc.is_paused():
+            source.cleanup()
+            return
+        attempts = player.resume_attempts
+        player.start_track(source, info)
+        player.resume_attempts = attempts
+        vc.play(source, after=lambda e: play_next_callback(ctx, e))
+    except Exception as e:
+        print(f"[ERROR] Could not resume '{track.title}': {e}")
+        if source is not None:
+            source.cleanup()
+        player.resuming = False
+        # Give up on this track the way a normal failure would.
+        play_next_callback(ctx, e)
+    finally:
+        # Also when the track was skipped or replaced meanwhile: a stale flag would freeze the
+        # progress bar and idle handling of every later track.
+        player.resuming = False
+
+# --- NOW PLAYING: One scheduler edits every guild's progress bar within a global budget ---
+def render_progress(elapsed, duration):
+    return f"`{format_time(elapsed)} / {format_time(duration)}`\n{create_progress_bar(elapsed, duration)}"
+
+class NowPlayingState:
+    __slots__ = ('message', 'embed', 'static_text', 'view', 'vc', 'duration',
+                 'elapsed', 'last_tick', 'next_due', 'last_rendered')
+
+    def __init__(self, message, embed, static_text, view, vc, duration, started_at):
+        self.message = message
+        self.embed = embed
+        self.static_text = static_text
+        self.view = view
+        self.vc = vc
+        self.duration = duration
+        self.elapsed = 0.0
+        self.last_tick = started_at
+        self.next_due = 0.0
+        # The message is sent with the 00:00 bar already rendered.
+        self.last_rendered = render_progress(0, duration)
+
+class NowPlayingScheduler:
+    """Owns all now-playing messages and refreshes their progress bars from a single task.
+
+    Each guild's refresh interval stretches as more guilds play, so the total edit rate
+    stays under edits_per_second no matter how many guilds are active.
+    """
+
+    TICK = 0.5
+
+    def __init__(self, edits_per_second, min_interval):
+        self.edits_per_second = edits_per_second
+        self.min_interval = min_interval
+        self.states = {}
+        self.edits = 0
+        self.skipped_edits = 0
+        self._allowance = 0.0
+        self._task = None
+        # guild id -> its edit still waiting on Discord (e.g. sleeping out a 429)
+        self._in_flight = {}
+
+    def register(self, guild_id, message, embed, static_text, view, vc, duration, started_at):
+        self.states[guild_id] = NowPlayingState(message, embed, static_text, view, vc, duration, started_at)
+        if self._task is None or self._task.done():
+            self._task = bot.loop.create_task(self._run())
+
+    def unregister(self, guild_id):
+        self.states.pop(guild_id, None)
+
+    def interval(self):
+        return max(self.min_interval, len(self.states) / self.edits_per_second)
+
+    async def _run(self):
+        while self.states:
+            await asyncio.sleep(self.TICK)
             try:
-                await now_playing_msg.edit(embed=current_embed, view=view)
-            except discord.errors.NotFound:
-                break
-            await asyncio.sleep(1)
+                await self._tick()
+            except Exception as e:
+                print(f"[ERROR] Error in now playing scheduler: {e}")
+
+    async def _tick(self):
+        now = time.monotonic()
+        self._allowance = min(self._allowance + self.edits_per_second * self.TICK, self.edits_per_second)
+        interval = self.interval()
+        due = []
+        for guild_id, state in list(self.states.items()):
+            player = players.get(guild_id)
+            if player is None or player.now_playing_msg is not state.message:
+                self.unregister(guild_id)
+                continue
+            # A stream being re-resolved after a failure is neither playing nor finished.
+            if player.resuming:
+                state.last_tick = now
+                continue
+            if player.source is not None and player.current is not None:
+                state.elapsed = player.source.position
+            elif state.vc.is_playing():
+                state.elapsed += now - state.last_tick
+            state.last_tick = now
+            if not state.vc.is_playing() and not state.vc.is_paused():
+                self.unregister(guild_id)
+                bot.loop.create_task(self._finish(state))
+                continue
+            if state.duration and state.elapsed >= state.duration + 2:
+                self.unregister(guild_id)
+                continue
+            if state.next_due <= now:
+                due.append((guild_id, state))
+
+        due.sort(key=lambda item: item[1].next_due)
+        for guild_id, state in due:
+            if guild_id in self._in_flight:
+                # The previous edit hasn't returned yet; check again next tick.
+                continue
+            state.next_due = now + interval
+            rendered = render_progress(int(state.elapsed), state.duration)
+            # A paused player renders the same bar tick after tick.
+            if rendered == state.last_rendered:
+                self.skipped_edits += 1
+                continue
+            if self._allowance < 1:
+                # Out of budget: retry on the next tick without waiting a full interval.
+                state.next_due = now
+                continue
+            self._allowance -= 1
+            state.last_rendered = rendered
+            state.embed.description = f"{state.static_text}\n\n{rendered}"
+            # Not awaited: a slow or rate-limited channel mustn't hold up the other guilds' bars.
+            task = bot.loop.create_task(self._edit(guild_id, state))
+            self._in_flight[guild_id] = task
+            task.add_done_callback(functools.partial(self._edit_done, guild_id))
+
+    def _edit_done(self, guild_id, task):
+        if self._in_flight.get(guild_id) is task:
+            del self._in_flight[guild_id]
+
+    async def _edit(self, guild_id, state):
+        try:
+            await state.message.edit(embed=state.embed, view=state.view)
+            self.edits += 1
+        except discord.errors.NotFound:
+            if self.states.get(guild_id) is state:
+                self.unregister(guild_id)
+        except discord.HTTPException as e:
+            print(f"[ERROR] Failed to update now playing message: {e}")
+
+    async def _finish(self, state):
+        try:
+            await state.message.edit(view=None)
+        except discord.HTTPException:
+            pass
 
-        if current_playing_messages.get(ctx.guild.id) and current_playing_messages[ctx.guild.id].id == original_message_id and not vc.is_playing() and not vc.is_paused():
-             await now_playing_msg.edit(view=None)
-    except Exception as e:
-        print(f"[ERROR] Error in update_progress_task: {e}")
+now_playing_scheduler = NowPlayingScheduler(PROGRESS_EDITS_PER_SECOND, PROGRESS_MIN_INTERVAL)
 
-async def play_next(ctx):
-    guild_id = ctx.guild.id
-    if guild_id in current_playing_messages:
+async def delete_now_playing(player):
+    if player.now_playing_msg is not None:
         try:
-            old_msg = current_playing_messages.pop(guild_id)
-            await old_msg.delete()
+            old_msg, player.now_playing_msg = player.now_playing_msg, None
+            with metrics.time('discord_delete'):
+                await old_msg.delete()
         except (discord.errors.NotFound, AttributeError):
             pass
 
-    if not music_queues.get(guild_id):
-        if loop_queue_states.get(guild_id, False):
-            history = played_songs.get(guild_id, [])
-            if history:
-                music_queues[guild_id] = history.copy()
-                played_songs[guild_id] = [] 
-        else:
-            current_song_info.pop(guild_id, None)
-            played_songs.pop(guild_id, None) 
+async def play_next(ctx, start=0):
+    """Plays the next queued track; start (seconds) resumes it mid-way, e.g. after a warm restart."""
+    guild_id = ctx.guild.id
+    # Its executor jobs (extraction, ffmpeg spawn) go ahead of everything else.
+    with executor_priority(PRIORITY_PLAY, guild_id):
+        player = get_player(guild_id)
+        await delete_now_playing(player)
+        # A session released while idle picks up where it stopped, backed up a little.
+        if player.suspended_at is not None:
+            start, player.suspended_at = max(start, player.suspended_at - 2, 0), None
+        player.auto_paused = False
+        player.left_channel_id = None
+
+        # The queue drained up to a playlist's unfetched tail: fetch its next page (or drop it if it's done).
+        while player.queue and isinstance(player.queue[0], PlaylistStream):
+            refill = request_playlist_refill(player, player.queue[0], PRIORITY_PLAY)
+            # A fetch already started at low water may still be waiting for a worker.
+            promote_guild_jobs(guild_id)
+            await asyncio.shield(refill)
+            if players.get(guild_id) is not player:
+                return
+
+        track = player.advance()
+        if track is None:
+            player.current = None
+            player.track_ended_at = None
+            player.history.clear()
+            invalidate_prefetch(player)
             await ctx.send("The queue has finished. Add more songs or use `/disconnect`.")
             return
 
-    if guild_id in music_queues and music_queues[guild_id]:
-        song_data = music_queues[guild_id].pop(0)
-        current_song_info[guild_id] = song_data
-
-        if guild_id not in played_songs:
-            played_songs[guild_id] = []
-        played_songs[guild_id].append(song_data)
-        
-        url = song_data['url']
-        requester_id = song_data['requester']['id']
+        url = track.url
+        started = time.perf_counter()
         try:
-            info = await extract_info_async(url)
-            if 'entries' in info and len(info['entries']) > 0:
-                info = info['entries'][0]
+            cached_audio = audio_cache.get(url)
+            if cached_audio:
+                info = cached_audio['metadata']
+                source = await spawn_audio_source(open_cached_audio, cached_audio['path'], start=start)
+                origin = 'audio_cache'
+            else:
+                info = await take_prefetched_info(player, track)
+                origin = 'prefetch'
+                if info is None:
+                    info = await extract_info_async(url)
+                    origin = 'extract'
+                    if 'entries' in info and len(info['entries']) > 0:
+                        info = info['entries'][0]
+                source = await spawn_audio_source(create_audio_source, info['url'], info.get('acodec'), start=start)
+            source = PlaybackSource(source, start_offset=start)
+            source.ended_at = player.track_ended_at
 
-            audio_url = info['url']
-            title = info.get('title', 'Unknown Title')
-            thumbnail = info.get('thumbnail', None)
-            duration = info.get('duration')
-            artist = info.get('artist') or info.get('uploader') or "Unknown Artist"
-
-            source = discord.FFmpegPCMAudio(audio_url, **ffmpeg_options)
             vc = ctx.voice_client
             if vc.is_playing() or vc.is_paused():
-                vc.stop()
+                player.skip(vc)
 
+            player.start_track(source, info)
             vc.play(source, after=lambda e: play_next_callback(ctx, e))
-
-            log_song({
-                'guild_name': ctx.guild.name, 'guild_id': ctx.guild.id, 'title': title,
-                'original_url': url, 'requester_name': song_data['requester']['name'],
-                'requester_id': requester_id
-            })
-
-            progress_bar = create_progress_bar(0, duration)
-            duration_str = format_time(duration) if duration else "LIVE"
-
-            description_text = (
-                f"**{title}**\n\n"
-                f"<:Orion_User:1389189744625188884> **Requested by:** <@{requester_id}>\n"
-                f"<:Orion_Timer:1386211890774151219> **Music Duration:** {duration_str}\n"
-                f"<:Orion_Partner:1386212658453151815> **Music Author:** {artist}\n\n"
-                f"`00:00 / {duration_str}`\n{progress_bar}"
-            )
-
-            embed = discord.Embed(
-                title="<a:Orion_VinylRecord:1386211619410804756>    Now Playing",
-                description=description_text,
-                color=discord.Color.green()
-            )
-            if thumbnail:
-                embed.set_thumbnail(url=thumbnail)
-
-            view = discord.ui.View(timeout=None)
-            view.add_item(discord.ui.Button(label="⏸ Pause", style=discord.ButtonStyle.primary, custom_id="pause"))
-            view.add_item(discord.ui.Button(label="▶ Resume", style=discord.ButtonStyle.success, custom_id="resume"))
-            view.add_item(discord.ui.Button(label="⏭ Skip", style=discord.ButtonStyle.secondary, custom_id="skip"))
-            view.add_item(discord.ui.Button(label="📜 Queue", style=discord.ButtonStyle.secondary, custom_id="queue"))
-            view.add_item(discord.ui.Button(label="⏹ Disconnect", style=discord.ButtonStyle.danger, custom_id="disconnect"))
-
-            now_playing_msg = await ctx.send(embed=embed, view=view)
-            current_playing_messages[guild_id] = now_playing_msg
-            
-            start_time = time.monotonic()
-            bot.loop.create_task(update_progress_task(ctx, now_playing_msg, title, duration, start_time, vc, embed, view))
+            started_at = time.monotonic()
+            # Dequeue to audio handed to the voice client.
+            metrics.observe('stage_seconds', time.perf_counter() - started, stage='play_next', outcome='ok')
+            metrics.inc('tracks_started_total', origin=origin)
+            await announce_track(ctx, player, track, info, vc, started_at)
 
         except Exception as e:
+            metrics.inc('tracks_failed_total')
             print(f"[ERROR] Playback error for {url}: {e}")
             await ctx.send(f"Error playing track: {e}")
+            # Song loop would otherwise pick the broken track again.
+            player.current = None
             await play_next(ctx)
-    else:
-        await ctx.send("The queue has finished. Add more songs or use `/disconnect`.")
-
-async def queue_playlist_tracks_background(interaction, entries, guild_id, requester_info, playlist_title):
-    urls_to_add = []
-    for entry in entries:
-        title = entry.get('title', 'Unknown Title')
-        urls_to_add.append({'url': entry['url'], 'title': title, 'requester': requester_info})
-
-    if urls_to_add:
-        music_queues[guild_id].extend(urls_to_add)
-        await interaction.followup.send(f"✅ Finished queuing {len(urls_to_add)} more tracks from **{playlist_title}**.", ephemeral=True)
-
-async def queue_spotify_tracks_background(interaction, track_queries, guild_id, requester_info):
-    urls_to_add = []
-    for track_query in track_queries:
-        youtube_url = await search_youtube_video(track_query)
+
+async def announce_track(ctx, player, track, info, vc, started_at):
+    """Everything after audio has started: prefetch, logging and the now-playing message."""
+    await delete_now_playing(player)
+    schedule_prefetch(player)
+    schedule_playlist_refill(player)
+
+    url = track.url
+    requester_id = track.requester.id
+    title = info.get('title', 'Unknown Title')
+    thumbnail = info.get('thumbnail', None)
+    duration = info.get('duration')
+    artist = info.get('artist') or info.get('uploader') or "Unknown Artist"
+
+    log_song({
+        'guild_name': ctx.guild.name, 'guild_id': ctx.guild.id, 'title': title,
+        'original_url': url, 'requester_name': track.requester.name,
+        'requester_id': requester_id
+    })
+    if not audio_cache.contains(url):
+        audio_cache.record_play(url, info)
+
+    duration_str = format_time(duration) if duration else "LIVE"
+
+    # Rendered once per track; the scheduler only swaps the progress lines below it.
+    static_text = (
+        f"**{title}**\n\n"
+        f"<:Orion_User:1389189744625188884> **Requested by:** <@{requester_id}>\n"
+        f"<:Orion_Timer:1386211890774151219> **Music Duration:** {duration_str}\n"
+        f"<:Orion_Partner:1386212658453151815> **Music Author:** {artist}"
+    )
+
+    embed = discord.Embed(
+        title="<a:Orion_VinylRecord:1386211619410804756>    Now Playing",
+        description=f"{static_text}\n\n{render_progress(0, duration)}",
+        color=discord.Color.green()
+    )
+    if thumbnail:
+        embed.set_thumbnail(url=thumbnail)
+
+    view = discord.ui.View(timeout=None)
+    view.add_item(discord.ui.Button(label="⏸ Pause", style=discord.ButtonStyle.primary, custom_id="pause"))
+    view.add_item(discord.ui.Button(label="▶ Resume", style=discord.ButtonStyle.success, custom_id="resume"))
+    view.add_item(discord.ui.Button(label="⏭ Skip", style=discord.ButtonStyle.secondary, custom_id="skip"))
+    view.add_item(discord.ui.Button(label="📜 Queue", style=discord.ButtonStyle.secondary, custom_id="queue"))
+    view.add_item(discord.ui.Button(label="⏹ Disconnect", style=discord.ButtonStyle.danger, custom_id="disconnect"))
+
+    with metrics.time('discord_send'):
+        now_playing_msg = await ctx.send(embed=embed, view=view)
+    player.now_playing_msg = now_playing_msg
+    now_playing_scheduler.register(player.guild_id, now_playing_msg, embed, static_text, view, vc, duration, started_at)
+
+# --- PLAYLIST STREAMS: Large YouTube playlists are fetched page by page as the queue drains ---
+YOUTUBE_PLAYLIST_REGEX = re.compile(r"youtube\.com/(?:playlist|watch)\?(?:.*&)?list=[A-Za-z0-9_-]+")
+
+class PlaylistStream:
+    """The not-yet-fetched rest of a playlist. It sits in the queue where those tracks belong.
+
+    Entries come from yt-dlp's raw (process=False) playlist generator, which requests the next
+    page from YouTube only when iterated. So a 5,000-video playlist holds a few pages of Tracks
+    in memory at most. A failed page is retried like an extraction: the generator is reopened on
+    another proxy and skips the entries already pulled.
+    """
+
+    __slots__ = ('url', 'title', 'requester', 'total', 'pulled', 'exhausted', 'task', '_entries', '_ydl', '_proxy')
+
+    def __init__(self, url, requester, title=None, total=None, pulled=0):
+        self.url = url
+        self.requester = requester
+        self.title = title
+        self.total = total
+        # Entries consumed so far, including ones skipped as unplayable; a restored stream skips this many.
+        self.pulled = pulled
+        self.exhausted = False
+        self.task = None
+        self._entries = None
+        self._ydl = None
+        self._proxy = None
+
+    @property
+    def remaining(self):
+        return max(self.total - self.pulled, 0) if self.total else None
+
+    def describe(self):
+        more = f"{self.remaining} more" if self.remaining else "More"
+        return f"*{more} from **{self.title or 'playlist'}** (loaded as the queue plays)*"
+
+    def _open_blocking(self, exclude_proxies=()):
+        opts = get_ytdlp_options(exclude_proxies=exclude_proxies)
+        opts['extract_flat'] = 'in_playlist'
+        self._proxy = opts.get('proxy')
+        # Not pooled: the generator keeps using this instance for as long as the playlist is queued.
+        self._ydl = get_yt_dlp().YoutubeDL(opts)
+        started = time.monotonic()
+        url = self.url
+        for _ in range(3):
+            info = self._ydl.extract_info(url, download=False, process=False)
+            if info.get('_type') not in ('url', 'url_transparent'):
+                break
+            url = info['url']
+        proxy_manager.record(self._proxy, 'ok', time.monotonic() - started)
+        self.title = self.title or info.get('title')
+        self.total = self.total or info.get('playlist_count')
+        self._entries = iter(info.get('entries') or ())
+        # A restored stream continues where the snapshot left off.
+        for _ in itertools.islice(self._entries, self.pulled):
+            pass
+
+    def _pull_blocking(self, count):
+        # Another extraction found this instance's proxy failing; later pages would fail on it too.
+        if self._proxy is not None and proxy_manager.cooling_down(self._proxy):
+            self.close()
+        entries = []
+        tried = set()
+        for attempt in range(EXTRACT_RETRIES + 1):
+            try:
+                if self._entries is None:
+                    self._open_blocking(exclude_proxies=tried)
+                while len(entries) < count:
+                    entry = next(self._entries, None)
+                    if entry is None:
+                        self.exhausted = True
+                        self.close()
+                        break
+                    self.pulled += 1
+                    if entry.get('url'):
+                        entries.append(entry)
+                return entries
+            except Exception as e:
+                outcome = classify_extraction_error(e)
+                proxy, self._proxy = self._proxy, None
+                self.close()
+                proxy_manager.record(proxy, 'ok' if outcome == 'content' else outcome)
+                if outcome == 'content' or attempt == EXTRACT_RETRIES:
+                    # Keep what this page got so far; the next refill starts over from there.
+                    if entries:
+                        return entries
+                    raise
+                if proxy is not None:
+                    tried.add(proxy)
+                # Reopening skips the `pulled` entries already taken, including this page's so far.
+                print(f"[PROXY] Playlist page via {safe_proxy_name(proxy or 'direct')} failed ({outcome}), reopening.")
+
+    async def pull(self, count):
+        """The next `count` playable entries as Tracks; fewer (and exhausted set) at the end."""
+        with metrics.time('playlist_page'):
+            entries = await executor.run(self._pull_blocking, count)
+        return [playlist_entry_track(entry, self.requester) for entry in entries]
+
+    def close(self):
+        ydl, self._ydl, self._entries = self._ydl, None, None
+        if ydl is not None:
+            try:
+                ydl.close()
+            except Exception:
+                pass
+
+def request_playlist_refill(player, stream, priority=PRIORITY_BACKGROUND):
+    """Starts fetching the stream's next page unless a fetch is already running; returns the task."""
+    if stream.task is None or stream.task.done():
+        with executor_priority(priority, player.guild_id):
+            stream.task = bot.loop.create_task(refill_playlist(player, stream))
+    return stream.task
+
+def schedule_playlist_refill(player):
+    """Tops up the first streamed playlist once fewer than PLAYLIST_LOW_WATER of its tracks are ahead of it."""
+    for item in itertools.islice(player.queue, PLAYLIST_LOW_WATER):
+        if isinstance(item, PlaylistStream):
+            request_playlist_refill(player, item)
+            return
+
+async def refill_playlist(player, stream):
+    failed = False
+    try:
+        tracks = await stream.pull(PLAYLIST_PAGE_SIZE)
+    except Exception as e:
+        # pull() already retried on other proxies.
+        print(f"[ERROR] Could not load more of playlist {stream.url}: {e}")
+        tracks = []
+        failed = True
+        stream.close()
+    if players.get(player.guild_id) is not player:
+        stream.close()
+        return
+    try:
+        index = player.queue.index(stream)
+    except ValueError:
+        # Removed from the queue meanwhile.
+        stream.close()
+        return
+    for track in reversed(tracks):
+        player.queue.insert(index, track)
+    if stream.exhausted or failed:
+        player.queue.remove(stream)
+    player.changed()
+    if failed and player.ctx is not None:
+        left = f"{stream.remaining} remaining tracks" if stream.remaining else "the rest"
+        try:
+            await player.ctx.send(f"⚠️ Could not load {left} of **{stream.title or 'the playlist'}** from YouTube; "
+                                  f"they were not queued.")
+        except discord.HTTPException:
+            pass
+    if tracks:
+        schedule_prefetch(player)
+        # Batched with the other tracks of the page.
+        missing = [track for track in tracks if track.duration is None or track.thumbnail is None]
+        if missing:
+            background_task(fill_track_metadata(missing, keep_titles=True), player.guild_id)
+
+def playlist_entry_track(entry, requester):
+    """Track from a flat playlist entry, which usually carries the duration and thumbnails already."""
+    thumbnails = entry.get('thumbnails') or []
+    thumbnail = entry.get('thumbnail') or (thumbnails[-1].get('url') if thumbnails else None)
+    return Track(entry['url'], entry.get('title', 'Unknown Title'), requester, entry.get('duration'), thumbnail)
+
+async def queue_playlist_tracks_background(interaction, entries, player, requester, playlist_title):
+    tracks = [playlist_entry_track(entry, requester) for entry in entries]
+
+    if tracks:
+        player.enqueue_many(tracks)
+        schedule_prefetch(player)
+        await interaction.followup.send(f"✅ Finished queuing {len(tracks)} more tracks from **{playlist_title}**.", ephemeral=True)
+        missing = [track for track in tracks if track.duration is None or track.thumbnail is None]
+        if missing:
+            await fill_track_metadata(missing, keep_titles=True)
+
+async def queue_spotify_tracks_background(interaction, track_queries, player, requester):
+    """Resolves up to SPOTIFY_RESOLVE_CONCURRENCY searches at once, queuing results in playlist order as they land."""
+    queries = iter(track_queries)
+    pending = deque()
+
+    def fill_window():
+        while len(pending) < SPOTIFY_RESOLVE_CONCURRENCY:
+            track_query = next(queries, None)
+            if track_query is None:
+                return
+            pending.append((track_query, bot.loop.create_task(search_youtube_video(track_query))))
+
+    total = len(track_queries)
+    processed = added = 0
+    progress_msg = None
+    last_report = time.monotonic()
+    fill_window()
+    while pending:
+        track_query, task = pending.popleft()
+        try:
+            youtube_url = await task
+        except Exception as e:
+            print(f"[ERROR] YouTube search failed for '{track_query}': {e}")
+            youtube_url = None
+        fill_window()
+        processed += 1
+
+        # The guild disconnected (player discarded) while we were resolving.
+        if players.get(player.guild_id) is not player:
+            for _, leftover in pending:
+                leftover.cancel()
+            return
         if youtube_url:
-            urls_to_add.append({'url': youtube_url, 'title': track_query, 'requester': requester_info})
+            track = Track(youtube_url, track_query, requester)
+            player.enqueue(track)
+            # Batched with the other tracks resolved around the same time.
+            bot.loop.create_task(fill_track_metadata([track]))
+            schedule_prefetch(player)
+            added += 1
+
+        if pending and time.monotonic() - last_report >= PROGRESS_REPORT_INTERVAL:
+            last_report = time.monotonic()
+            content = f"⏳ Resolved {processed} of {total} Spotify tracks ({added} queued so far)..."
+            try:
+                if progress_msg is None:
+                    progress_msg = await interaction.followup.send(content, ephemeral=True, wait=True)
+                else:
+                    await progress_msg.edit(content=content)
+            except discord.HTTPException:
+                pass
+
+    if added:
+        await interaction.followup.send(f"✅ Finished queuing {added} more tracks from Spotify.", ephemeral=True)
+
+# --- METRICS: Gauges read when /metrics or /stats is rendered ---
+def executor_queue_depth():
+    """Jobs waiting for a free thread (or extraction process), per priority class."""
+    depth = executor.queue_depth()
+    if extraction_processes is not None:
+        depth.update(extraction_processes.queue_depth())
+    return depth
+
+def executor_busy_workers():
+    busy = {executor.name: executor.running}
+    if extraction_processes is not None:
+        busy[extraction_processes.name] = extraction_processes.running
+    return busy
+
+metrics.gauge('executor_queue_depth', "Jobs waiting for an executor worker.", executor_queue_depth, label='queue')
+metrics.gauge('executor_busy_workers', "Executor workers running a job.", executor_busy_workers, label='executor')
+metrics.gauge('event_loop_lag_last_seconds', "Last measured event loop lag.", lambda: round(loop_lag_monitor.last, 4))
+metrics.gauge('event_loop_lag_max_seconds', "Worst event loop lag since start.", lambda: round(loop_lag_monitor.max, 4))
+metrics.gauge('players', "Guilds with player state.", lambda: len(players))
+metrics.gauge('voice_connections', "Connected voice clients.", lambda: len(bot.voice_clients))
+metrics.gauge('queued_tracks', "Tracks waiting in all queues.", lambda: sum(player.queued_count() for player in players.values()))
+metrics.gauge('extraction_cache_entries', "Entries in the extraction cache.", lambda: extraction_cache.stats()['size'])
+metrics.gauge('ytdl_pool', "Warm yt-dlp instance pool.", ytdl_pool.stats, label='stat')
+metrics.gauge('audio_cache', "On-disk audio cache.", audio_cache.stats, label='stat')
+metrics.gauge('inter_track_gap_ms', "Gap between tracks over the last 200 transitions.",
+              lambda: {key: value for key, value in gap_stats().items() if key != 'count'}, label='stat')
+
+# --- COMMAND SYNC: only push the slash-command tree when it changed ---
+def get_command_tree_hash():
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()), key=lambda c: c['name'])
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+def load_command_sync_state():
+    try:
+        with open(COMMAND_SYNC_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+async def sync_commands_if_changed():
+    """Global sync is slow and rate-limited, so it only runs when the tree differs from the last one synced."""
+    tree_hash = get_command_tree_hash()
+    state = load_command_sync_state()
+    # Every shard process sees the same global commands; the one owning shard 0 syncs them.
+    if SHARD_IDS and 0 not in SHARD_IDS:
+        return
+    app_id = str(bot.application_id)
+    if state.get(app_id) == tree_hash:
+        print(f"[INFO] Slash commands unchanged ({tree_hash[:8]}), skipping sync.")
+        return
+    synced = await bot.tree.sync()
+    print(f'[INFO] Synced {len(synced)} slash commands globally.')
+    state[app_id] = tree_hash
+    try:
+        with open(COMMAND_SYNC_FILE, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+    except OSError as e:
+        print(f"[ERROR] Could not save command sync state: {e}")
 
-    if urls_to_add:
-        music_queues[guild_id].extend(urls_to_add)
-        await interaction.followup.send(f"✅ Finished queuing {len(urls_to_add)} more tracks from Spotify.", ephemeral=True)
+boot_reported = False
 
 @bot.event
 async def on_ready():
+    global boot_reported
     print(f'[INFO] Logged in as {bot.user} (ID: {bot.user.id})')
+    bot.loop.create_task(search_cache.load())
+    bot.loop.create_task(audio_cache.load())
+    bot.loop.create_task(player_store.load())
     try:
-        synced = await bot.tree.sync()
-        print(f'[INFO] Synced {len(synced)} slash commands globally.')
+        await sync_commands_if_changed()
     except Exception as e:
         print(f"[ERROR] Failed to sync commands: {e}")
+    # on_ready fires again after a full reconnect; the boot timing and warm-up only matter once.
+    if not boot_reported:
+        boot_reported = True
+        print(f"[BOOT] Ready to answer commands {time.perf_counter() - BOOT_STARTED:.2f}s after start "
+              f"(imports and setup {BOOT_IMPORTED - BOOT_STARTED:.2f}s).")
+        # Pay for the yt-dlp import now rather than on the first /play.
+        background_task(executor.run(get_yt_dlp))
+        loop_lag_monitor.start()
+        player_sweeper.start()
+        idle_monitor.start()
+        if loop_stall_watchdog is not None:
+            loop_stall_watchdog.start()
+        if METRICS_PORT:
+            try:
+                await start_metrics_server()
+            except OSError as e:
+                print(f"[ERROR] Could not start the metrics endpoint: {e}")
+
+# --- IDLE SESSIONS: Nobody listening means no ffmpeg, no stream connection and eventually no voice ---
+def pause_when_alone(vc, player):
+    if IDLE_PAUSE_WHEN_ALONE and vc.is_playing():
+        vc.pause()
+        if player is not None:
+            player.auto_paused = True
+        metrics.inc('idle_actions_total', action='pause')
+        print(f"[IDLE] Alone in '{vc.channel.name}' ({vc.guild.name}), paused.")
+
+def suspend_player(player, vc):
+    """Stops the paused source (ffmpeg and its stream connection) but keeps the queue and the position."""
+    if player.source is None or player.current is None:
+        return
+    # Live streams have no position to return to; they rejoin at the live edge.
+    player.suspended_at = player.source.position if player.duration else 0.0
+    player.source = None
+    invalidate_prefetch(player)
+    # The now-playing message stays, so its Resume button can bring the track back.
+    now_playing_scheduler.unregister(player.guild_id)
+    player.rewind()
+    player.releasing = True
+    # Resuming isn't a track change; without this, inter_track_gap_ms would count the whole pause.
+    player.track_ended_at = None
+    vc.stop()
+    metrics.inc('idle_actions_total', action='release')
+    print(f"[IDLE] Released the paused stream in '{vc.guild.name}' at {format_time(player.suspended_at)}.")
+
+async def resume_session(player, vc):
+    """Continues a session the idle policy (or a user) paused: unpause, or reopen a released track."""
+    if vc.is_paused():
+        vc.resume()
+    elif player is not None and player.ctx is not None and not vc.is_playing():
+        # Stream URLs are cached for a while, so this is usually an ffmpeg spawn and no extraction.
+        await play_next(player.ctx)
+    if player is not None:
+        player.auto_paused = False
+
+async def rejoin_idle_session(guild, channel, player):
+    if player.ctx is None or (player.suspended_at is None and not player.queue):
+        return
+    player.left_channel_id = None
+    await channel.connect()
+    player.ctx = ChannelContext(guild, player.ctx.channel)
+    print(f"[IDLE] Listener back in '{channel.name}' ({guild.name}), rejoined.")
+    await resume_session(player, guild.voice_client)
+
+async def idle_disconnect(vc, player):
+    """Leaves voice but keeps the player: /play, the Resume button or a listener returning picks it up."""
+    if player is not None:
+        suspend_player(player, vc)
+        player.left_channel_id = vc.channel.id
+    metrics.inc('idle_actions_total', action='disconnect')
+    print(f"[IDLE] Left '{vc.channel.name}' ({vc.guild.name}) after {IDLE_DISCONNECT_AFTER}s without playing.")
+    await vc.disconnect()
+
+class IdleMonitor:
+    """Applies the idle policy to every voice connection: release paused streams, then leave."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        # guild_id -> monotonic time the connection was first seen not playing
+        self.idle_since = {}
+        self._task = None
+
+    def start(self):
+        if (IDLE_RELEASE_AFTER or IDLE_DISCONNECT_AFTER or IDLE_PAUSE_WHEN_ALONE) and (self._task is None or self._task.done()):
+            self._task = background_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                print(f"[ERROR] Idle check failed: {e}")
+
+    async def check(self):
+        now = time.monotonic()
+        connected = set()
+        for vc in list(bot.voice_clients):
+            if not vc.is_connected():
+                continue
+            guild_id = vc.guild.id
+            connected.add(guild_id)
+            player = players.get(guild_id)
+            # Catches anyone leaving while the bot was reconnecting and missed the voice event.
+            if not any(not m.bot for m in vc.channel.members):
+                pause_when_alone(vc, player)
+            if vc.is_playing() or (player is not None and player.resuming):
+                self.idle_since.pop(guild_id, None)
+                continue
+            idle = now - self.idle_since.setdefault(guild_id, now)
+            if IDLE_DISCONNECT_AFTER and idle >= IDLE_DISCONNECT_AFTER:
+                self.idle_since.pop(guild_id, None)
+                await idle_disconnect(vc, player)
+            elif IDLE_RELEASE_AFTER and idle >= IDLE_RELEASE_AFTER and vc.is_paused() and player is not None:
+                suspend_player(player, vc)
+        for guild_id in [guild_id for guild_id in self.idle_since if guild_id not in connected]:
+            del self.idle_since[guild_id]
+
+idle_monitor = IdleMonitor(IDLE_CHECK_INTERVAL)
 
 @bot.event
 async def on_voice_state_update(member, before, after):
-    if member.id == bot.user.id:
+    if member.bot:
         return
-    vc = member.guild.voice_client
-    if not vc:
+    guild = member.guild
+    vc = guild.voice_client
+    player = players.get(guild.id)
+    if vc is None or not vc.is_connected():
+        # Someone came back to the channel the bot left while nobody was listening.
+        if player is not None and player.auto_paused and after.channel is not None \
+                and after.channel.id == player.left_channel_id:
+            await rejoin_idle_session(guild, after.channel, player)
         return
-    if len(vc.channel.members) == 1:
-        print(f"[DEBUG] Bot is now alone in '{vc.channel.name}' but will remain connected.")
+    if not any(not m.bot for m in vc.channel.members):
+        pause_when_alone(vc, player)
+    elif player is not None and player.auto_paused and after.channel == vc.channel:
+        print(f"[IDLE] {member.display_name} is back in '{vc.channel.name}' ({guild.name}), resuming.")
+        await resume_session(player, vc)
 
 @bot.event
 async def on_interaction(interaction: discord.Interaction):
@@ -453,68 +3297,68 @@ async def on_interaction(interaction: discord.Interaction):
 
     custom_id = interaction.data.get("custom_id")
     vc = interaction.guild.voice_client
-    
-    log_event({
-        'guild_name': interaction.guild.name, 'guild_id': interaction.guild.id,
-        'event': f"{custom_id}_button", 'user_name': interaction.user.display_name,
-        'user_id': interaction.user.id
-    })
-
+    # Discord gives us 3 seconds to acknowledge. Each branch answers first; anything that needs
+    # the network or the disk runs after the response (or after a defer).
+    try:
+        await handle_button(interaction, custom_id, vc)
+    finally:
+        log_event({
+            'guild_name': interaction.guild.name, 'guild_id': interaction.guild.id,
+            'event': f"{custom_id}_button", 'user_name': interaction.user.display_name,
+            'user_id': interaction.user.id
+        })
+
+async def handle_button(interaction, custom_id, vc):
     if not vc:
         await interaction.response.send_message("I'm not connected to a voice channel.", ephemeral=True)
         return
 
+    player = players.get(interaction.guild.id)
     if custom_id == "pause":
         if vc.is_playing():
             vc.pause()
+            if player is not None:
+                # Paused on purpose; someone joining the channel shouldn't unpause it.
+                player.auto_paused = False
             await interaction.response.send_message("Paused.", ephemeral=True)
         else:
             await interaction.response.send_message("Nothing is playing.", ephemeral=True)
     elif custom_id == "resume":
-        if vc.is_paused():
-            vc.resume()
+        if vc.is_paused() or (player is not None and player.suspended_at is not None and not vc.is_playing()):
             await interaction.response.send_message("Resumed.", ephemeral=True)
+            await resume_session(player, vc)
         else:
             await interaction.response.send_message("Already playing.", ephemeral=True)
     elif custom_id == "skip":
         if vc.is_playing() or vc.is_paused():
-            vc.stop()
+            get_player(interaction.guild.id).skip(vc)
             await interaction.response.send_message("Skipped.", ephemeral=True)
         else:
             await interaction.response.send_message("Nothing to skip.", ephemeral=True)
     elif custom_id == "queue":
         await interaction.response.defer(ephemeral=True)
         guild_id = interaction.guild.id
-        queue = music_queues.get(guild_id, [])
+        player = get_player(guild_id)
         description = ""
-        if queue:
-            description = "\n".join(f"**{i+1}.** {item['title']}" for i, item in enumerate(queue[:10]))
-            if len(queue) > 10:
-                description += f"\n... and {len(queue) - 10} more."
+        if player.queued_count():
+            description = "\n".join(f"**{i+1}.** {item.describe()}" for i, item in enumerate(player.upcoming(10)))
+            if player.queued_count() > 10:
+                description += f"\n... and {player.queued_count() - 10} more."
         else:
             description = "The queue is empty."
         embed = discord.Embed(title="🎶 Current Queue", description=description, color=discord.Color.blue())
         await interaction.followup.send(embed=embed, ephemeral=True)
     elif custom_id == "disconnect":
-        guild_id = interaction.guild.id
-        music_queues.pop(guild_id, None)
-        loop_states.pop(guild_id, None)
-        loop_queue_states.pop(guild_id, None)
-        current_song_info.pop(guild_id, None)
-        played_songs.pop(guild_id, None)
-        if guild_id in current_playing_messages:
-             try:
-                msg = current_playing_messages.pop(guild_id)
-                await msg.delete()
-             except: pass
-        await vc.disconnect()
         await interaction.response.send_message("Disconnected and cleared the queue.", ephemeral=True)
+        await discard_player(interaction.guild.id)
+        await vc.disconnect()
 
 @bot.tree.command(name="ping", description="Replies with pong!")
 async def ping(interaction: discord.Interaction):
     await interaction.response.send_message(f"Pong! Latency: {round(bot.latency * 1000)}ms")
 
 @bot.tree.command(name="play", description="Plays a song or playlist from YouTube, Spotify, etc.")
+@metrics.timed('play_command')
 @app_commands.describe(search_term="The URL or name of the song/playlist.")
 async def play(interaction: discord.Interaction, search_term: str):
     await interaction.response.defer()
@@ -539,16 +3383,13 @@ async def play(interaction: discord.Interaction, search_term: str):
             return await self.channel.send(*args, **kwargs)
 
     ctx = InteractionContext(interaction)
-    guild_id = ctx.guild.id
-    if guild_id not in music_queues:
-        music_queues[guild_id] = []
-
-    context_for_guild[guild_id] = ctx
-    requester_info = {'name': interaction.user.display_name, 'id': interaction.user.id, 'mention': interaction.user.mention}
+    # Each command runs as a task of its own; this tags its executor jobs for the guild's fair share.
+    executor_context.set((PRIORITY_INTERACTIVE, ctx.guild.id))
+    player = get_player(ctx.guild.id)
+    player.ctx = ctx
+    requester = get_requester(interaction.user)
 
     try:
-        loop = asyncio.get_event_loop()
-
         if SPOTIFY_URL_REGEX.match(search_term):
             spotify_info = await get_spotify_track_info(search_term)
             
@@ -561,13 +3402,17 @@ async def play(interaction: discord.Interaction, search_term: str):
                 if not youtube_url:
                     await interaction.edit_original_response(content=f"Couldn't find the first track '{first_track_query}' on YouTube.")
                     return
-                title = await extract_title(youtube_url)
-                music_queues[guild_id].append({'url': youtube_url, 'title': title, 'requester': requester_info})
+                # videos.list is one cheap API call; a yt-dlp extraction here only delayed the reply.
+                metadata = await metadata_service.get(get_youtube_video_id(youtube_url)) or {}
+                player.enqueue(Track(youtube_url, metadata.get('title') or first_track_query, requester,
+                                     metadata.get('duration'), metadata.get('thumbnail')))
                 await interaction.edit_original_response(content=f"▶️ Playing first song from Spotify. Queuing the rest in the background...")
                 if spotify_info:
-                    bot.loop.create_task(queue_spotify_tracks_background(interaction, spotify_info, guild_id, requester_info))
-                if not vc.is_playing() and not vc.is_paused():
+                    background_task(queue_spotify_tracks_background(interaction, spotify_info, player, requester), player.guild_id)
+                if not vc.is_playing() and not vc.is_paused() and not player.resuming:
                     await play_next(ctx)
+                else:
+                    schedule_prefetch(player)
                 return
             elif isinstance(spotify_info, str):
                 search_term = await search_youtube_video(spotify_info)
@@ -582,18 +3427,46 @@ async def play(interaction: discord.Interaction, search_term: str):
                 return
             search_term = url
 
+        # A single YouTube video only needs its title to be queued; the stream is extracted when it plays.
+        video_id = get_youtube_video_id(search_term)
+        metadata = await metadata_service.get(video_id) if video_id else None
+        if metadata:
+            title = metadata.get('title') or 'Unknown Title'
+            player.enqueue(Track(metadata.get('webpage_url') or f"https://www.youtube.com/watch?v={video_id}", title, requester, metadata.get('duration'), metadata.get('thumbnail')))
+            await interaction.edit_original_response(content=f"✅ Added `{title}` to the queue.")
+            if not vc.is_playing() and not vc.is_paused() and not player.resuming:
+                await play_next(ctx)
+            else:
+                schedule_prefetch(player)
+            return
+
+        # A YouTube playlist is streamed: one page now, the rest as the queue drains.
+        if video_id is None and YOUTUBE_PLAYLIST_REGEX.search(search_term):
+            stream = PlaylistStream(search_term, requester)
+            tracks = await stream.pull(PLAYLIST_PAGE_SIZE)
+            if not tracks:
+                await interaction.edit_original_response(content="Could not find playable tracks in the playlist.")
+                return
+            player.enqueue_many(tracks if stream.exhausted else [*tracks, stream])
+            size = f" ({stream.total} tracks)" if stream.total else ""
+            await interaction.edit_original_response(content=f"✅ Queued **{stream.title or 'playlist'}**{size}.")
+            missing = [track for track in tracks if track.duration is None or track.thumbnail is None]
+            if missing:
+                background_task(fill_track_metadata(missing, keep_titles=True), player.guild_id)
+            if not vc.is_playing() and not vc.is_paused() and not player.resuming:
+                await play_next(ctx)
+            else:
+                schedule_prefetch(player)
+                schedule_playlist_refill(player)
+            return
+
         # DYNAMIC EXTRACTOR CALL
         # Note: We now call get_ytdlp_options() inside the extract_info_async wrapper
         # so this part handles standard playlist/url parsing first.
         # However, for the initial probe, we use the base options to be safe.
         
         # We need to manually invoke the rotator if we want the initial check to also be proxied
-        from yt_dlp import YoutubeDL
-        current_opts = get_ytdlp_options()
-        current_opts.update({'extract_flat': 'in_playlist'})
-        
-        ydl = YoutubeDL(current_opts)
-        info = await loop.run_in_executor(executor, lambda: ydl.extract_info(search_term, download=False))
+        info = await run_extraction(search_term, {'extract_flat': 'in_playlist'})
         
         if not info:
             await interaction.edit_original_response(content="Could not retrieve information from the link.")
@@ -606,26 +3479,22 @@ async def play(interaction: discord.Interaction, search_term: str):
                 return
             playlist_title = info.get('title', 'playlist')
             first_entry = valid_entries.pop(0)
-            music_queues[guild_id].append({
-                'url': first_entry['url'],
-                'title': first_entry.get('title', 'Unknown Title'),
-                'requester': requester_info
-            })
+            player.enqueue(playlist_entry_track(first_entry, requester))
             await interaction.edit_original_response(content=f"▶️ Playing first song from **{playlist_title}**. Queuing the rest in the background...")
             if valid_entries:
-                bot.loop.create_task(queue_playlist_tracks_background(interaction, valid_entries, guild_id, requester_info, playlist_title))
-            if not vc.is_playing() and not vc.is_paused():
+                background_task(queue_playlist_tracks_background(interaction, valid_entries, player, requester, playlist_title), player.guild_id)
+            if not vc.is_playing() and not vc.is_paused() and not player.resuming:
                 await play_next(ctx)
+            else:
+                schedule_prefetch(player)
         else:
             title = info.get('title', 'Unknown Title')
-            music_queues[guild_id].append({
-                'url': info['original_url'],
-                'title': title,
-                'requester': requester_info
-            })
+            player.enqueue(Track(info['original_url'], title, requester))
             await interaction.edit_original_response(content=f"✅ Added `{title}` to the queue.")
-            if not vc.is_playing() and not vc.is_paused():
+            if not vc.is_playing() and not vc.is_paused() and not player.resuming:
                 await play_next(ctx)
+            else:
+                schedule_prefetch(player)
     except Exception as e:
         print(f"[ERROR] Generic error in /play command: {e}")
         if not interaction.response.is_done():
@@ -642,44 +3511,40 @@ async def play(interaction: discord.Interaction, search_term: str):
     app_commands.Choice(name="Turn Off (All)", value="off"),
 ])
 async def loop(interaction: discord.Interaction, mode: app_commands.Choice[str]):
-    guild_id = interaction.guild.id
+    player = get_player(interaction.guild.id)
     vc = interaction.guild.voice_client
+    player.changed()
 
     if mode.value == "song_on":
         if not vc or not (vc.is_playing() or vc.is_paused()):
             await interaction.response.send_message("A song must be playing to enable song loop.", ephemeral=True)
             return
-        loop_states[guild_id] = True
-        loop_queue_states[guild_id] = False 
+        player.loop_song = True
+        player.loop_queue = False
         await interaction.response.send_message("🔁 Looping the current **song** is now **ON**.", ephemeral=True)
     elif mode.value == "song_off":
-        loop_states[guild_id] = False
+        player.loop_song = False
         await interaction.response.send_message("Looping the current song is now **OFF**.", ephemeral=True)
     elif mode.value == "queue_on":
-        loop_queue_states[guild_id] = True
-        loop_states[guild_id] = False
+        player.loop_queue = True
+        player.loop_song = False
+        schedule_prefetch(player)
         await interaction.response.send_message("🔁 Looping the entire **queue** is now **ON**.", ephemeral=True)
     elif mode.value == "queue_off":
-        loop_queue_states[guild_id] = False
+        player.loop_queue = False
         await interaction.response.send_message("Looping the queue is now **OFF**.", ephemeral=True)
     elif mode.value == "off":
-        loop_states[guild_id] = False
-        loop_queue_states[guild_id] = False
+        player.loop_song = False
+        player.loop_queue = False
         await interaction.response.send_message("All looping is now **disabled**.", ephemeral=True)
 
 @bot.tree.command(name="disconnect", description="Disconnects the bot from the voice channel and clears the queue.")
 async def disconnect(interaction: discord.Interaction):
     vc = interaction.guild.voice_client
     if vc:
-        guild_id = interaction.guild.id
-        music_queues.pop(guild_id, None)
-        if guild_id in current_playing_messages:
-             try:
-                msg = current_playing_messages.pop(guild_id)
-                await msg.delete()
-             except: pass
-        await vc.disconnect()
         await interaction.response.send_message("Disconnected and cleared the queue.")
+        await discard_player(interaction.guild.id)
+        await vc.disconnect()
     else:
         await interaction.response.send_message("I am not in a voice channel.", ephemeral=True)
 
@@ -687,7 +3552,7 @@ async def disconnect(interaction: discord.Interaction):
 async def skip(interaction: discord.Interaction):
     vc = interaction.guild.voice_client
     if vc and (vc.is_playing() or vc.is_paused()):
-        vc.stop()
+        get_player(interaction.guild.id).skip(vc)
         await interaction.response.send_message("Skipped.")
     else:
         await interaction.response.send_message("Nothing to skip.", ephemeral=True)
@@ -695,16 +3560,15 @@ async def skip(interaction: discord.Interaction):
 @bot.tree.command(name="queue", description="Displays the current song queue.")
 async def queue(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
-    guild_id = interaction.guild.id
-    queue_items = music_queues.get(guild_id, [])
+    player = get_player(interaction.guild.id)
     
     description = ""
     vc = interaction.guild.voice_client
     if vc and vc.is_playing():
         description += "**__Now Playing:__**\n"
-        if guild_id in current_playing_messages:
+        if player.now_playing_msg is not None:
             try:
-                msg = current_playing_messages[guild_id]
+                msg = player.now_playing_msg
                 title = msg.embeds[0].description.split('\n')[0].strip()
                 description += f"🎵 {title}\n\n"
             except (IndexError, AttributeError):
@@ -712,17 +3576,52 @@ async def queue(interaction: discord.Interaction):
         else:
             description += "🎵 *Currently playing a track.*\n\n"
 
-    if queue_items:
+    if player.queued_count():
         description += "**__Up Next:__**\n"
-        description += "\n".join(f"**{i+1}.** {item['title']} - *Requested by {item['requester']['mention']}*" for i, item in enumerate(queue_items[:10]))
-        if len(queue_items) > 10:
-            description += f"\n... and {len(queue_items) - 10} more."
+        description += "\n".join(f"**{i+1}.** {item.describe()} - *Requested by {item.requester.mention}*" for i, item in enumerate(player.upcoming(10)))
+        if player.queued_count() > 10:
+            description += f"\n... and {player.queued_count() - 10} more."
     elif not vc or not vc.is_playing():
         description = "The queue is empty and nothing is playing."
         
     embed = discord.Embed(title="🎶 Music Queue", description=description, color=discord.Color.blue())
     await interaction.followup.send(embed=embed, ephemeral=True)
 
+@bot.tree.command(name="proxies", description="Shows which proxies are carrying traffic (admin only).")
+@app_commands.default_permissions(administrator=True)
+async def proxies(interaction: discord.Interaction):
+    dump = proxy_manager.dump()
+    print(f"[PROXY] Stats requested by {interaction.user.display_name}:\n{dump}")
+    if not proxy_manager.proxies:
+        await interaction.response.send_message("No proxies are configured.", ephemeral=True)
+        return
+    # Keep inside Discord's 2000 character message limit.
+    await interaction.response.send_message(f"```\n{dump[:1900]}\n```", ephemeral=True)
+
+@bot.tree.command(name="stats", description="Shows stage latencies and load (admin only).")
+@app_commands.default_permissions(administrator=True)
+async def stats(interaction: discord.Interaction):
+    lines = [f"{'stage':<18} {'calls':>7} {'errors':>6} {'avg':>8} {'p95':>7}"]
+    for stage, calls, errors, avg, p95 in metrics.stage_summary():
+        p95_text = f"<{p95:g}s" if p95 != float('inf') else f">{LATENCY_BUCKETS[-1]}s"
+        lines.append(f"{stage:<18} {calls:>7} {errors:>6} {avg * 1000:>6.0f}ms {p95_text:>7}")
+    lines.append("")
+    for priority, calls, _, avg, p95 in metrics.stage_summary('executor_wait_seconds', 'priority'):
+        p95_text = f"<{p95:g}s" if p95 != float('inf') else f">{LATENCY_BUCKETS[-1]}s"
+        lines.append(f"{'wait ' + priority:<18} {calls:>7} {'':>6} {avg * 1000:>6.0f}ms {p95_text:>7}")
+    depth = executor_queue_depth()
+    lines.append(f"executor queue {', '.join(f'{name} {value}' for name, value in depth.items())} | "
+                 f"loop lag {loop_lag_monitor.last * 1000:.0f}ms (max {loop_lag_monitor.max * 1000:.0f}ms)")
+    lines.append(f"players {len(players)} | voice {len(bot.voice_clients)} | "
+                 f"extraction cache {extraction_cache.stats()['hit_rate']:.0%} hits | "
+                 f"coalesced {extraction_flights.coalesced} extractions, {search_flights.coalesced} searches")
+    dump = "\n".join(lines)
+    print(f"[STATS] Requested by {interaction.user.display_name}:\n{dump}")
+    # Keep inside Discord's 2000 character message limit.
+    await interaction.response.send_message(f"```\n{dump[:1900]}\n```", ephemeral=True)
+
+BOOT_IMPORTED = time.perf_counter()
+
 if __name__ == '__main__':
     try:
         bot.run(TOKEN)
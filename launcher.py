@@ -0,0 +1,122 @@
+# Runs bot.py as several processes, each owning a contiguous range of shards.
+#
+#   python launcher.py                 # one process per CPU core, shard count recommended by Discord
+#   python launcher.py <processes>     # fixed number of processes
+#
+# SHARD_COUNT in .env overrides Discord's recommendation. Every other variable in .env is passed
+# through unchanged, so EXTRACT_PROCESSES etc. apply to each process.
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+# A worker that crashes is restarted after this delay, doubling on each crash in a row (capped).
+RESTART_DELAY = 5
+RESTART_DELAY_MAX = 300
+# A worker that stayed up this long counts as healthy again.
+STABLE_SECONDS = 600
+
+def recommended_shard_count(token):
+    request = urllib.request.Request("https://discord.com/api/v10/gateway/bot",
+                                     headers={'Authorization': f"Bot {token}", 'User-Agent': 'Orion launcher'})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)['shards']
+
+def split_shards(shard_count, processes):
+    """Contiguous shard ranges, as even as possible: 10 shards over 3 processes -> 0-3, 4-6, 7-9."""
+    processes = max(1, min(processes, shard_count))
+    ranges, start = [], 0
+    for index in range(processes):
+        size = shard_count // processes + (1 if index < shard_count % processes else 0)
+        ranges.append((start, start + size - 1))
+        start += size
+    return ranges
+
+class Worker:
+    def __init__(self, shard_count, first, last):
+        self.shard_count = shard_count
+        self.first = first
+        self.last = last
+        self.process = None
+        self.started = 0.0
+        self.crashes = 0
+        self.restart_at = 0.0
+
+    @property
+    def label(self):
+        return f"shard {self.first}-{self.last}"
+
+    def start(self):
+        env = dict(os.environ, SHARD_COUNT=str(self.shard_count), SHARD_IDS=f"{self.first}-{self.last}",
+                   PYTHONUNBUFFERED='1')
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, text=True, encoding='utf-8', errors='replace')
+        self.started = time.monotonic()
+        threading.Thread(target=self._forward_output, args=(self.process,), daemon=True).start()
+        print(f"[LAUNCHER] Started {self.label} (pid {self.process.pid}).")
+
+    def _forward_output(self, process):
+        for line in process.stdout:
+            print(f"[{self.label}] {line}", end='', flush=True)
+
+    def check(self):
+        """Restarts the worker (with backoff) if it exited."""
+        now = time.monotonic()
+        if self.process is None:
+            if now >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is None:
+            return
+        if now - self.started >= STABLE_SECONDS:
+            self.crashes = 0
+        self.crashes += 1
+        delay = min(RESTART_DELAY * 2 ** (self.crashes - 1), RESTART_DELAY_MAX)
+        print(f"[LAUNCHER] {self.label} exited with code {code}, restarting in {delay}s.")
+        self.process = None
+        self.restart_at = now + delay
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            # SIGINT lets bot.run() close the connection and the log writer flush on exit.
+            self.process.send_signal(signal.SIGINT if sys.platform != "win32" else signal.SIGTERM)
+
+def main():
+    load_dotenv()
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() or 1
+    shard_count = int(os.getenv('SHARD_COUNT', 0)) or recommended_shard_count(os.getenv('DISCORD_BOT_TOKEN'))
+    workers = [Worker(shard_count, first, last) for first, last in split_shards(shard_count, processes)]
+    print(f"[LAUNCHER] {shard_count} shards over {len(workers)} processes.")
+
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopping.set())
+
+    for index, worker in enumerate(workers):
+        # Discord allows one IDENTIFY every 5 s per bucket; stagger the first logins a little.
+        worker.restart_at = time.monotonic() + index * 5
+    while not stopping.is_set():
+        for worker in workers:
+            worker.check()
+        stopping.wait(1)
+
+    print("[LAUNCHER] Stopping workers...")
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        if worker.process is not None:
+            try:
+                worker.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                worker.process.kill()
+
+if __name__ == '__main__':
+    main()